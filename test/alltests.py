@@ -1,7 +1,7 @@
 import webtest
 
 def suite():
-    modules = ["doctests", "db", "application", "session"]
+    modules = ["doctests", "db", "application", "session", "wsgiserver"]
     return webtest.suite(modules)
     
 if __name__ == "__main__":
@@ -1,7 +1,9 @@
 import webtest
-import time
+import os, shutil, tempfile, time
+from SimpleHTTPServer import SimpleHTTPRequestHandler
 
 import web
+from web.httpserver import StaticMiddleware
 import urllib
 
 data = """
@@ -111,6 +113,44 @@ class ApplicationTest(webtest.TestCase):
         app.add_processor(processor)
         self.assertEquals(app.request('/blog/foo').data, '/blog/foo:blog foo')
     
+    def test_route_order(self):
+        urls = (
+            "/(a|b)", "first",
+            "/a", "second",
+            "/static", "static",
+            "/s.*", "pattern",
+        )
+        class first:
+            def GET(self, x): return "first " + x
+        class second:
+            def GET(self): return "second"
+        class static:
+            def GET(self): return "static"
+        class pattern:
+            def GET(self): return "pattern"
+        app = web.application(urls, locals())
+
+        self.assertEquals(app.request('/a').data, 'first a')
+        self.assertEquals(app.request('/static').data, 'static')
+        self.assertEquals(app.request('/stat').data, 'pattern')
+        self.assertEquals(app.request('/x').status, '404 Not Found')
+
+        class late:
+            def GET(self, x): return "late " + x
+        app.fvars = dict(app.fvars, late=late)
+        app.add_mapping("/x(.*)", "late")
+        self.assertEquals(app.request('/xyz').data, 'late yz')
+
+    def test_many_routes(self):
+        urls = ()
+        for i in range(150):
+            urls += ("/%d/(\d+)/(\w+)" % i, "page")
+        class page:
+            def GET(self, a, b): return a + b
+        app = web.application(urls, locals())
+        self.assertEquals(app.request('/149/1/x').data, '1x')
+        self.assertEquals(app.request('/0/2/y').data, '2y')
+
     def test_subdomains(self):
         def create_app(name):
             urls = ("/", "index")
@@ -199,6 +239,26 @@ class ApplicationTest(webtest.TestCase):
         assert state.x == 1 and state.y == 1, repr(state)
         app.request('/foo')
         assert state.x == 1 and state.y == 2, repr(state)
+
+        # processors replaced in place are used from the next request
+        app.processors[-1] = web.loadhook(f)
+        app.request('/foo')
+        assert state.x == 2 and state.y == 2, repr(state)
+
+        # and so are new lists of processors
+        app.processors = app.processors[:-1]
+        app.request('/foo')
+        assert state.x == 2 and state.y == 2, repr(state)
+
+        # timing is switched on and off by web.config
+        web.config.processor_timing = True
+        try:
+            app.request('/foo')
+            self.assertEquals([t.calls for t in app.processor_timings()], [1] * len(app.processors))
+        finally:
+            web.config.processor_timing = False
+        app.request('/foo')
+        self.assertEquals(app.processor_timings(), [])
         
     def testUnicodeInput(self):
         urls = (
@@ -234,6 +294,162 @@ class ApplicationTest(webtest.TestCase):
         response = app.request('/multipart', method="POST", data=data, headers=headers)
         self.assertEquals(response.data, 'a')
         
+    def test_multipart(self):
+        urls = (
+            "/input", "input",
+            "/parts", "parts",
+        )
+        class input:
+            def POST(self):
+                i = web.input(x=[])
+                return "%s %s %s" % (i.x, i.file.filename, len(i.file.value))
+        class parts:
+            def POST(self):
+                return ", ".join(["%s=%d" % (p.name, len(p.read())) for p in web.iterparts()])
+        app = web.application(urls, locals())
+
+        content = 'x' * 100000
+        data = ('--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\n1\r\n'
+                '--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\n2\r\n'
+                '--boundary\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+                'Content-Type: text/plain\r\n\r\n' + content + '\r\n--boundary--\r\n')
+        headers = {'Content-Type': 'multipart/form-data; boundary=boundary', 'Content-Length': str(len(data))}
+
+        web.config.upload_memory_threshold = 1000
+        try:
+            response = app.request('/input', method="POST", data=data, headers=headers)
+        finally:
+            del web.config.upload_memory_threshold
+        self.assertEquals(response.data, "[u'1', u'2'] a.txt 100000")
+
+        response = app.request('/parts', method="POST", data=data, headers=headers)
+        self.assertEquals(response.data, "x=1, x=1, file=100000")
+
+    def test_data(self):
+        urls = ("/", "index")
+        class index:
+            def POST(self):
+                chunks = list(web.data_stream(4))
+                return "%s %s" % (chunks, repr(web.data()))
+            PATCH = POST
+        app = web.application(urls, locals())
+
+        self.assertEquals(app.request('/', method='POST', data='0123456789').data, "['0123', '4567', '89'] ''")
+
+        # a body of unknown length (e.g. chunked) is read until EOF
+        import StringIO
+        env = {'wsgi.input': StringIO.StringIO('0123456789'), 'wsgi.input_terminated': True}
+        self.assertEquals(app.request('/', method='PATCH', env=env).data, "['0123', '4567', '89'] ''")
+
+        web.config.max_body_size = 5
+        try:
+            response = app.request('/', method='POST', data='0123456789')
+            env = {'wsgi.input': StringIO.StringIO('0123456789'), 'wsgi.input_terminated': True}
+            response2 = app.request('/', method='PATCH', env=env)
+        finally:
+            del web.config.max_body_size
+        self.assertEquals(response.status, '413 Request Entity Too Large')
+        self.assertEquals(response2.status, '413 Request Entity Too Large')
+
+    def test_cookies(self):
+        urls = ("/", "index")
+        class index:
+            def GET(self):
+                web.setcookie("b", "x/y", domain="example.com", secure=True, httponly=True)
+                return repr(sorted(web.cookies(c="3").items()))
+        app = web.application(urls, locals())
+
+        response = app.request('/', headers={'Cookie': 'a=1; b="x%20y"; $Path=/'})
+        self.assertEquals(response.data, "[('a', '1'), ('b', 'x y'), ('c', '3')]")
+        self.assertEquals(response.headers['Set-Cookie'], 'b="x/y"; Domain=example.com; Path=/; secure; httponly')
+
+    def test_wsgifunc_response(self):
+        urls = ("/str", "str_", "/gen", "gen")
+        class str_:
+            def GET(self):
+                return u"\u1234"
+        class gen:
+            def GET(self):
+                yield "a"
+                yield "b"
+        app = web.application(urls, locals())
+        wsgi = app.wsgifunc()
+
+        env = {'PATH_INFO': '/str', 'REQUEST_METHOD': 'GET'}
+        result = wsgi(env, lambda status, headers: None)
+        self.assertEquals(result, ['\xe1\x88\xb4'])
+        result.close()
+        self.assertEquals(web.ctx.keys(), [])
+
+        env = {'PATH_INFO': '/gen', 'REQUEST_METHOD': 'GET'}
+        result = wsgi(env, lambda status, headers: None)
+        self.assertEquals(list(result), ['a', 'b'])
+        result.close()
+
+    def test_finalize(self):
+        urls = ("/", "index")
+        class index:
+            def GET(self):
+                return "hello"
+        app = web.application(urls, locals())
+
+        self.assertEquals(app.request('/').headers.get('Content-Length'), None)
+
+        web.config.content_length = web.config.etag = True
+        try:
+            response = app.request('/')
+            etag = response.headers['ETag']
+            self.assertEquals(response.headers['Content-Length'], '5')
+            self.assertEquals(etag, '"5d41402abc4b2a76b9719d911017c592"')
+
+            response = app.request('/', headers={'If-None-Match': etag})
+            self.assertEquals(response.status, '304 Not Modified')
+            self.assertEquals(response.data, '')
+            self.assertEquals(response.headers.get('Content-Length'), None)
+        finally:
+            del web.config.content_length, web.config.etag
+
+    def test_gzip(self):
+        import zlib
+        urls = ("/", "index")
+        class index:
+            def GET(self):
+                web.header('Content-Type', 'text/html')
+                yield "a" * 1000
+                yield "b" * 1000
+        app = web.application(urls, locals())
+        wsgi = app.wsgifunc(web.GzipMiddleware)
+
+        headers = {}
+        def start_response(status, response_headers, exc_info=None):
+            headers.update(response_headers)
+        env = {'PATH_INFO': '/', 'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        result = wsgi(env, start_response)
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEquals([d.decompress(chunk) for chunk in result], ["a" * 1000, "b" * 1000, ""])
+        result.close()
+        self.assertEquals(headers['Content-Encoding'], 'gzip')
+        self.assertEquals(headers['Vary'], 'Accept-Encoding')
+
+    def test_gzip_errors(self):
+        import sys
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            yield 'a' * 1000
+            try:
+                raise ValueError('oops')
+            except ValueError:
+                start_response('500 Internal Server Error', [], sys.exc_info())
+        wsgi = web.GzipMiddleware(app)
+        def start_response(status, response_headers, exc_info=None):
+            return lambda data: None
+        env = {'PATH_INFO': '/', 'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        # the error can't be reported once the response has begun
+        self.assertRaises(ValueError, list, wsgi(env, start_response))
+
+        wsgi = web.GzipMiddleware(lambda environ, start_response: [])
+        self.assertRaises(AssertionError, list, wsgi(env, start_response))
+
     def testCustomNotFound(self):
         urls_a = ("/", "a")
         urls_b = ("/", "b")
@@ -293,6 +509,18 @@ class ApplicationTest(webtest.TestCase):
         app.request('/bar')
         self.assertEquals(x.a, 2)
         
+    def test_ctx(self):
+        urls = ("/(.*)", "index")
+        class index:
+            def GET(self, name):
+                web.ctx.path = '/changed'
+                assert 'realhome' in web.ctx
+                return repr((web.ctx.fullpath, web.ctx.home, web.ctx.get('protocol'), web.ctx.path))
+        app = web.application(urls, locals())
+
+        response = app.request('/foo?x=1', env={'SCRIPT_NAME': '/x'}, https=True)
+        self.assertEquals(response.data, repr((u'/foo?x=1', u'https://0.0.0.0:8080/x', u'https', '/changed')))
+
     def test_changequery(self):
         urls = (
             '/', 'index',
@@ -308,5 +536,124 @@ class ApplicationTest(webtest.TestCase):
         self.assertEquals(f('/?x=2'), '/?x=1')
         self.assertEquals(f('/?y=1&y=2&x=2'), '/?y=1&y=2&x=1')
 
+class StaticTest(webtest.TestCase):
+    """Tests for StaticMiddleware, run in a temporary directory with a
+    static/ subdirectory.
+    """
+    def setUp(self):
+        self.cwd, self.root = os.getcwd(), tempfile.mkdtemp()
+        os.chdir(self.root)
+        os.mkdir('static')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def request(self, wsgi, path, **env):
+        """Calls `wsgi` for a GET of `path` and returns the response status,
+        headers and body.
+        """
+        env.update(PATH_INFO=path, REQUEST_METHOD='GET')
+        response = []
+        def start_response(status, response_headers, exc_info=None):
+            response[:] = [status, dict(response_headers)]
+        result = wsgi(env, start_response)
+        data = ''.join(result)
+        if hasattr(result, 'close'):
+            result.close()
+        return response[0], response[1], data
+
+    def test_file_wrapper(self):
+        wrappers = []
+        class Wrapper:
+            def __init__(self, f, blksize):
+                self.f = f
+                wrappers.append(self)
+            def __iter__(self):
+                return iter([self.f.read()])
+            def close(self):
+                self.f.close()
+        write('static/a.txt', 'hello')
+        wsgi = StaticMiddleware(web.application(('/', 'index'), {}).wsgifunc())
+        status, headers, data = self.request(wsgi, '/static/a.txt', 
+                                             **{'wsgi.file_wrapper': Wrapper})
+        self.assertEquals(len(wrappers), 1)
+        self.assertEquals(data, 'hello')
+        self.assertEquals(headers['Content-Length'], '5')
+
+    def test_cache(self):
+        write('static/a.css', 'a {}')
+        wsgi = StaticMiddleware(None, cache_size=1024, cache_check_interval=0)
+        status, headers, data = self.request(wsgi, '/static/a.css')
+        self.assertEquals(data, 'a {}')
+        self.assertEquals(headers['Content-Length'], '4')
+        self.assertEquals(wsgi.cache.size, 4)
+
+        # changes are noticed
+        write('static/a.css', 'b {}')
+        os.utime('static/a.css', (0, 0))
+        status, headers, data = self.request(wsgi, '/static/a.css')
+        self.assertEquals(data, 'b {}')
+
+        status, _, data = self.request(wsgi, '/static/a.css', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEquals(status, '304 Not Modified')
+        self.assertEquals(data, '')
+
+    def test_cache_misses(self):
+        write('static/big.txt', 'x' * 100)
+        wsgi = StaticMiddleware(None, cache_size=1024, cache_max_file_size=10)
+        translated = []
+        translate_path = SimpleHTTPRequestHandler.translate_path
+        def f(self, path):
+            translated.append(path)
+            return translate_path(self, path)
+        SimpleHTTPRequestHandler.translate_path = f
+        try:
+            for i in range(2):
+                status, headers, data = self.request(wsgi, '/static/big.txt')
+                self.assertEquals(data, 'x' * 100)
+                status, headers, data = self.request(wsgi, '/static/missing.txt')
+                self.assertEquals(status, '404 File not found')
+        finally:
+            SimpleHTTPRequestHandler.translate_path = translate_path
+        # translated once, then remembered
+        self.assertEquals(translated, ['/static/big.txt', '/static/missing.txt'])
+        self.assertEquals(sorted(wsgi.cache.misses), ['/static/big.txt', '/static/missing.txt'])
+        self.assertEquals(wsgi.cache.size, 0)
+
+        # changes are noticed
+        wsgi.cache.check_interval = 0
+        write('static/missing.txt', 'found')
+        status, headers, data = self.request(wsgi, '/static/missing.txt')
+        self.assertEquals(data, 'found')
+        self.assertEquals(wsgi.cache.size, 5)
+        self.assertEquals(wsgi.cache.misses.keys(), ['/static/big.txt'])
+
+    def test_ranges(self):
+        write('static/a.txt', '0123456789')
+        for cache_size in [0, 1024]:
+            wsgi = StaticMiddleware(None, cache_size=cache_size)
+            def request(**env):
+                return self.request(wsgi, '/static/a.txt', **env)
+
+            status, headers, data = request(HTTP_RANGE='bytes=2-4')
+            self.assertEquals(status, '206 Partial Content')
+            self.assertEquals(headers['Content-Range'], 'bytes 2-4/10')
+            self.assertEquals(data, '234')
+
+            status, headers, data = request(HTTP_RANGE='bytes=0-0,-2')
+            self.assertTrue(headers['Content-type'].startswith('multipart/byteranges'))
+            self.assertEquals(len(data), int(headers['Content-Length']))
+            self.assertTrue('Content-Range: bytes 8-9/10\r\n\r\n89\r\n' in data)
+
+            status, headers, data = request(HTTP_RANGE='bytes=20-')
+            self.assertEquals(status, '416 Requested Range Not Satisfiable')
+
+            last_modified = request()[1]['Last-Modified']
+            status, headers, data = request(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"stale"')
+            self.assertEquals(data, '0123456789')
+            status, headers, data = request(HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEquals(status, '304 Not Modified')
+
 if __name__ == '__main__':
     webtest.main()
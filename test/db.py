@@ -51,6 +51,19 @@ class DBTest(webtest.TestCase):
         t.rollback()        
         self.assertRows(0)
         
+    def testTransactionLeftOpen(self):
+        # a transaction left open by a request is rolled back after it
+        db = self.db
+        class index:
+            def GET(self):
+                db.transaction()
+                db.insert('person', False, name='user1')
+                raise web.seeother('/')
+        app = web.application(('/', 'index'), locals())
+        app.request('/')
+        self.assertEquals(len(db.ctx.transactions), 0)
+        self.assertRows(0)
+
     def testWrongQuery(self):
         # It should be possible to run a correct query after getting an error from a wrong query.
         try:
@@ -0,0 +1,540 @@
+"""wsgiserver test"""
+import webtest
+import httplib, os, random, signal, socket, subprocess, sys, tempfile, shutil, threading, time, urllib2
+from StringIO import StringIO
+
+import web
+from web import wsgiserver
+
+class ServerTest(webtest.TestCase):
+    def setUp(self):
+        self.server = None
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.sockets = []
+
+    def tearDown(self):
+        self.release.set()
+        for s in self.sockets:
+            s.close()
+        if self.server is not None:
+            self.server.stop()
+            self.thread.join(5)
+
+    def app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        if path == '/block':
+            self.entered.set()
+            self.release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [path]
+
+    def start(self, attrs=None, **kw):
+        """Starts a server for `self.app` on a free port, with the
+        constructor arguments `kw` and the attributes `attrs`.
+        """
+        server = wsgiserver.CherryPyWSGIServer(('127.0.0.1', 0), self.app, **kw)
+        for k, v in (attrs or {}).items():
+            setattr(server, k, v)
+        server.listen()
+        self.port = server.socket.getsockname()[1]
+        self.server = server
+        self.thread = threading.Thread(target=server.start)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.wait_for(lambda: server.ready)
+        return server
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail('timed out')
+            time.sleep(0.01)
+
+    def connect(self, timeout=5):
+        s = socket.create_connection(('127.0.0.1', self.port), timeout)
+        self.sockets.append(s)
+        return s
+
+    def request(self, s, path='/', version='HTTP/1.1'):
+        s.sendall('GET %s %s\r\nHost: localhost\r\n\r\n' % (path, version))
+
+    def read_response(self, s):
+        """Reads a response with a Content-Length from `s` and returns its
+        status, headers and body.
+        """
+        f = s.makefile('rb', 0)
+        try:
+            status = f.readline()
+            if not status:
+                return None, {}, ''
+            headers = {}
+            while True:
+                line = f.readline()
+                if line in ('\r\n', ''):
+                    break
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            body = f.read(int(headers.get('content-length', 0)))
+            return status.split(' ', 1)[1].strip(), headers, body
+        finally:
+            f.close()
+
+    def closed(self, s):
+        """Returns True if the server closed `s`."""
+        try:
+            return s.recv(1) == ''
+        except socket.error:
+            return True
+
+class KeepAliveTest(ServerTest):
+    def test_keepalive_parks_connection(self):
+        server = self.start(numthreads=2)
+        s = self.connect()
+        for i in range(3):
+            self.request(s, '/%d' % i)
+            self.assertEquals(self.read_response(s)[::2], ('200 OK', '/%d' % i))
+            # the connection waits in the poller, not in a worker thread
+            self.wait_for(lambda: server.poller.parked == 1)
+            self.wait_for(lambda: server.requests.idle == 2)
+
+    def test_pipelining(self):
+        self.start()
+        s = self.connect()
+        s.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                  'GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                  'GET /c HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        self.assertEquals(self.read_response(s)[2], '/a')
+        self.assertEquals(self.read_response(s)[2], '/b')
+        self.assertEquals(self.read_response(s)[2], '/c')
+        self.assertTrue(self.closed(s))
+
+    def test_idle_timeout(self):
+        server = self.start(timeout=1)
+        s = self.connect()
+        self.request(s)
+        self.read_response(s)
+        idle = self.connect()
+        start = time.time()
+        self.assertTrue(self.closed(s))
+        self.assertTrue(self.closed(idle))
+        self.assertTrue(time.time() - start < 3)
+        self.assertEquals(server.poller.parked, 0)
+
+    def test_no_poller(self):
+        self.start(attrs={'park_idle_connections': False})
+        s = self.connect()
+        self.request(s, '/a')
+        self.request(s, '/b')
+        self.assertEquals(self.read_response(s)[2], '/a')
+        self.assertEquals(self.read_response(s)[2], '/b')
+
+class OverloadTest(ServerTest):
+    def fill(self, server):
+        """Keeps the only worker thread busy and fills the queue."""
+        busy = self.connect()
+        self.request(busy, '/block')
+        self.entered.wait(5)
+        queued = self.connect()
+        self.request(queued, '/queued')
+        self.wait_for(server.requests.full)
+        return busy, queued
+
+    def test_reject(self):
+        server = self.start(numthreads=1, accepted_queue_size=1)
+        busy, queued = self.fill(server)
+        s = self.connect()
+        status, headers, body = self.read_response(s)
+        self.assertEquals(status, '503 Service Unavailable')
+        self.assertEquals(headers['retry-after'], str(server.retry_after))
+
+        self.release.set()
+        self.assertEquals(self.read_response(busy)[0], '200 OK')
+        self.assertEquals(self.read_response(queued)[2], '/queued')
+
+    def test_pause(self):
+        server = self.start(numthreads=1, accepted_queue_size=1,
+                            attrs={'overload_policy': 'pause'})
+        busy, queued = self.fill(server)
+        s = self.connect()
+        self.request(s, '/late')
+        s.settimeout(0.5)
+        # left in the listen backlog
+        self.assertRaises(socket.timeout, s.recv, 1)
+        s.settimeout(5)
+
+        self.release.set()
+        self.assertEquals(self.read_response(busy)[0], '200 OK')
+        self.assertEquals(self.read_response(queued)[2], '/queued')
+        self.assertEquals(self.read_response(s)[2], '/late')
+
+    def test_pause_keeps_polling(self):
+        server = self.start(numthreads=1, accepted_queue_size=1, timeout=1,
+                            attrs={'overload_policy': 'pause'})
+        s = self.connect()
+        self.request(s, '/a')
+        self.read_response(s)
+        idle = self.connect()
+        start = time.time()
+        busy, queued = self.fill(server)
+
+        # the request waits in the poller for room in the queue, while
+        # idle connections still time out
+        self.request(s, '/b')
+        self.assertTrue(self.closed(idle))
+        self.assertTrue(time.time() - start < 3)
+
+        self.release.set()
+        self.assertEquals(self.read_response(busy)[0], '200 OK')
+        self.assertEquals(self.read_response(queued)[2], '/queued')
+        self.assertEquals(self.read_response(s)[2], '/b')
+
+    def test_pause_timeout(self):
+        server = self.start(numthreads=1, accepted_queue_size=1, 
+                            accepted_queue_timeout=0.5,
+                            attrs={'overload_policy': 'pause'})
+        s = self.connect()
+        self.request(s, '/a')
+        self.read_response(s)
+        busy, queued = self.fill(server)
+        self.request(s, '/b')
+        self.assertEquals(self.read_response(s)[0], '503 Service Unavailable')
+
+class ThreadPoolTest(ServerTest):
+    def test_scaling(self):
+        server = self.start(numthreads=1, max=3)
+        server.requests.idle_timeout = 1
+        sockets = [self.connect() for i in range(3)]
+        for s in sockets:
+            self.request(s, '/block')
+        self.wait_for(lambda: server.requests.size == 3)
+        self.release.set()
+        for s in sockets:
+            self.assertEquals(self.read_response(s)[0], '200 OK')
+        self.wait_for(lambda: server.requests.size == 1)
+        self.assertEquals(server.requests.peak, 3)
+
+    def test_shrink_with_full_queue(self):
+        server = self.start(numthreads=1, max=2, accepted_queue_size=1)
+        pool = server.requests
+        # (connections are accepted only while the queue is empty, as
+        # the server rejects them when it's full)
+        sockets = [self.connect()]
+        self.request(sockets[0], '/block')
+        self.entered.wait(5)
+        sockets.append(self.connect())
+        self.request(sockets[1], '/block')
+        self.wait_for(lambda: pool.size == 2 and pool.idle == 0 and not pool.full())
+        sockets.append(self.connect())
+        self.request(sockets[2], '/queued')
+        self.wait_for(pool.full)
+
+        # shrinking waits for room in the queue, without stopping the 
+        # workers from making it
+        shrink = threading.Thread(target=pool.shrink, args=(1,))
+        shrink.setDaemon(True)
+        shrink.start()
+        time.sleep(0.1)
+        self.release.set()
+        for s in sockets:
+            self.assertEquals(self.read_response(s)[0], '200 OK')
+        shrink.join(5)
+        self.assertFalse(shrink.isAlive())
+        self.wait_for(lambda: pool.size == 1)
+
+class ShutdownTest(ServerTest):
+    def test_acceptors(self):
+        server = self.start(attrs={'acceptors': 3})
+        def acceptors():
+            return [t for t in threading.enumerate() if t.getName().endswith('(acceptor)')]
+        self.wait_for(lambda: len(acceptors()) == 2)
+        acceptors = acceptors()
+        s = self.connect()
+        self.request(s)
+        self.assertEquals(self.read_response(s)[0], '200 OK')
+
+        server.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.isAlive())
+        for t in acceptors:
+            t.join(5)
+            self.assertFalse(t.isAlive())
+        self.assertRaises(socket.error, socket.create_connection, ('127.0.0.1', self.port), 1)
+        self.server = None
+
+class RequestTest(ServerTest):
+    def test_bare_lf(self):
+        for attrs in [{}, {'park_idle_connections': False}]:
+            self.start(attrs=attrs)
+            for head in ['GET / HTTP/1.0\n\n',
+                         'GET / HTTP/1.1\r\nHost: localhost\n\n',
+                         'GET / HTTP/1.1\nHost: localhost\r\n\r\n']:
+                s = self.connect(timeout=2)
+                s.sendall(head)
+                self.assertEquals(self.read_response(s)[0], '400 Bad Request')
+            self.server.stop()
+            self.thread.join(5)
+
+    def test_chunked_body_too_large(self):
+        urls = ('/', 'index')
+        class index:
+            def POST(self):
+                return str(len(web.data()))
+        self.app = web.application(urls, locals()).wsgifunc()
+        class Request(wsgiserver.HTTPRequest):
+            max_request_body_size = 1000
+        class Connection(wsgiserver.HTTPConnection):
+            RequestHandlerClass = Request
+        self.start(attrs={'ConnectionClass': Connection})
+        debug, web.config.debug = web.config.debug, False
+        try:
+            for size in [100, 2000]:
+                s = self.connect()
+                s.sendall('POST / HTTP/1.1\r\nHost: localhost\r\n'
+                          'Transfer-Encoding: chunked\r\n\r\n'
+                          '%x\r\n%s\r\n0\r\n\r\n' % (size, 'x' * size))
+                status, headers, body = self.read_response(s)
+                if size == 100:
+                    self.assertEquals((status, body), ('200 OK', '100'))
+                else:
+                    self.assertEquals(status, '413 Request Entity Too Large')
+        finally:
+            web.config.debug = debug
+
+class ResponseTest(ServerTest):
+    def test_chunked_response(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield 'hello, '
+            yield ''
+            yield 'world'
+        self.app = app
+        self.start()
+        s = self.connect()
+        self.request(s)
+        f = s.makefile('rb', 0)
+        self.assertEquals(f.readline(), 'HTTP/1.1 200 OK\r\n')
+        headers = []
+        while True:
+            line = f.readline()
+            if line == '\r\n':
+                break
+            headers.append(line.split(':')[0].lower())
+        self.assertTrue('transfer-encoding' in headers)
+        body = ''
+        while True:
+            size = int(f.readline(), 16)
+            chunk = f.read(size + 2)
+            if not size:
+                break
+            body += chunk[:-2]
+        self.assertEquals(body, 'hello, world')
+
+    def test_content_length(self):
+        self.start()
+        s = self.connect()
+        self.request(s, '/abc')
+        status, headers, body = self.read_response(s)
+        self.assertEquals(headers['content-length'], '4')
+        self.assertEquals(body, '/abc')
+
+class FakeSocket:
+    """A socket whose recv returns chunks of random size. With `overflow`,
+    they can be larger than asked for, as with SSL_fileobject.
+    """
+    def __init__(self, data, rand, overflow=False):
+        self.data = data
+        self.rand = rand
+        self.overflow = overflow
+
+    def recv(self, size):
+        if self.overflow:
+            size *= 2
+        n = self.rand.randint(1, size)
+        data, self.data = self.data[:n], self.data[n:]
+        return data
+
+    def recv_into(self, buf, size):
+        data = self.recv(size)
+        buf[:len(data)] = data
+        return len(data)
+
+class FileObjectTest(webtest.TestCase):
+    def compare(self, seed, overflow=False):
+        """Checks that a sequence of random reads from a CP_fileobject
+        returns the same as the same reads from a StringIO.
+        """
+        class fileobject(wsgiserver.CP_fileobject):
+            use_recv_into = not overflow
+
+        rand = random.Random(seed)
+        data = ''.join(rand.choice('ab\r\n') for i in range(5000))
+        expected = StringIO(data)
+        f = fileobject(FakeSocket(data, rand, overflow), 'rb', rand.choice([0, 16, -1]))
+        while expected.tell() < len(data) - 100:
+            op = rand.choice(['read', 'readline', 'readuntil'])
+            if op == 'read':
+                args = [rand.choice([0, 1, 10, 100, 10000])]
+            elif op == 'readline':
+                args = rand.choice([[], [1], [10], [100]])
+            else:
+                args = [rand.choice(['\n', '\r\n\r\n', wsgiserver.head_delims])]
+            result = getattr(f, op)(*args)
+            if op == 'readuntil':
+                self.assertEquals(result, self.readuntil(expected, *args), (seed, op, args))
+            else:
+                self.assertEquals(result, getattr(expected, op)(*args), (seed, op, args))
+        self.assertEquals(f.read(), expected.read())
+
+    def readuntil(self, f, delims):
+        """Reads from the StringIO `f` up to the first of `delims`."""
+        if isinstance(delims, str):
+            delims = (delims,)
+        data, pos = f.getvalue(), f.tell()
+        found = [(data.find(d, pos), d) for d in delims if d in data[pos:]]
+        if not found:
+            return f.read()
+        i, d = min(found)
+        return f.read(i + len(d) - pos)
+
+    def test_reads(self):
+        for seed in range(50):
+            self.compare(seed)
+
+    def test_reads_overflow(self):
+        for seed in range(50):
+            self.compare(seed, overflow=True)
+
+class PreforkTest(webtest.TestCase):
+    app = """
+import web
+import handlers
+
+urls = ('/main', 'main', '/module', 'handlers.module')
+
+class main:
+    def GET(self):
+        return 'main %s'
+
+app = web.application(urls, globals())
+
+if __name__ == '__main__':
+    app.run()
+"""
+    handlers = """
+class module:
+    def GET(self):
+        return 'module %s'
+"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.process = None
+
+    def tearDown(self):
+        if self.process is not None and self.process.poll() is None:
+            os.kill(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+        shutil.rmtree(self.dir)
+
+    def _testable(self):
+        if not hasattr(os, 'fork'):
+            print >> web.debug, "os.fork not available (ignoring %s)" % self.__class__.__name__
+            return False
+        return True
+
+    def write(self, version):
+        for name in ['app', 'handlers']:
+            f = open(os.path.join(self.dir, name + '.py'), 'w')
+            f.write(getattr(self, name) % version)
+            f.close()
+
+    def get(self, path):
+        try:
+            return urllib2.urlopen('http://127.0.0.1:%d%s' % (self.port, path), timeout=5).read()
+        except (IOError, socket.error):
+            return None
+
+    def wait_for(self, path, data, timeout=10):
+        deadline = time.time() + timeout
+        while self.get(path) != data:
+            if time.time() > deadline or self.process.poll() is not None:
+                self.fail('%s never returned %r' % (path, data))
+            time.sleep(0.1)
+
+    def test_reload(self):
+        if not self._testable():
+            return
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        self.port = s.getsockname()[1]
+        s.close()
+
+        self.write(1)
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1',
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(web.__file__))))
+        self.process = subprocess.Popen(
+            [sys.executable, 'app.py', 'prefork=2', '127.0.0.1:%d' % self.port], 
+            cwd=self.dir, env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        self.wait_for('/main', 'main 1')
+        self.assertEquals(self.get('/module'), 'module 1')
+
+        # handlers in both the main script and an imported module change
+        self.write(2)
+        os.kill(self.process.pid, signal.SIGHUP)
+        self.wait_for('/main', 'main 2')
+        self.wait_for('/module', 'module 2')
+        self.assertEquals(self.process.poll(), None)
+
+        # the new workers' connections work as before
+        for i in range(4):
+            conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+            for path in ['/main', '/module']:
+                conn.request('GET', path)
+                self.assertEquals(conn.getresponse().read(), path[1:] + ' 2')
+            conn.close()
+            time.sleep(0.1)
+
+class SSLTest(ServerTest):
+    def setUp(self):
+        ServerTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ServerTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def _testable(self):
+        if wsgiserver.ssl is None:
+            print >> web.debug, "ssl module not available (ignoring %s)" % self.__class__.__name__
+            return False
+        self.cert = os.path.join(self.dir, 'cert.pem')
+        self.key = os.path.join(self.dir, 'key.pem')
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', 
+                '-nodes', '-days', '1', '-subj', '/CN=localhost', 
+                '-keyout', self.key, '-out', self.cert], 
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError), e:
+            print >> web.debug, str(e), "(ignoring %s)" % self.__class__.__name__
+            return False
+        return True
+
+    def test_https(self):
+        if not self._testable():
+            return
+        self.start(attrs={'ssl_certificate': self.cert, 'ssl_private_key': self.key})
+        s = wsgiserver.ssl.wrap_socket(self.connect())
+        self.sockets.append(s)
+        for path in ['/a', '/b']:
+            self.request(s, path)
+            self.assertEquals(self.read_response(s)[::2], ('200 OK', path))
+
+        # plain HTTP on the HTTPS port
+        s = self.connect()
+        self.request(s)
+        self.assertEquals(self.read_response(s)[0], '400 Bad Request')
+
+if __name__ == "__main__":
+    webtest.main()
@@ -4,9 +4,8 @@ Web application
 (from web.py)
 """
 import webapi as web
-import webapi, wsgi, utils
+import webapi, wsgi, utils, http
 import debugerror
-from utils import lstrips, safeunicode
 import sys
 
 import urllib
@@ -14,7 +13,9 @@ import traceback
 import itertools
 import os
 import re
+import time
 import types
+import weakref
 from exceptions import SystemExit
 
 try:
@@ -22,6 +23,13 @@ try:
 except ImportError:
     pass # don't break people with old Pythons
 
+try:
+    import hashlib
+    md5 = hashlib.md5
+except ImportError:
+    import md5 as _md5
+    md5 = _md5.new
+
 __all__ = [
     "application", "auto_application",
     "subdir_application", "subdomain_application", 
@@ -47,6 +55,8 @@ class application:
         self.mapping = mapping
         self.fvars = fvars
         self.processors = []
+        self._routes = None
+        _applications[self] = True
         
         self.add_processor(loadhook(self._load))
         self.add_processor(unloadhook(self._unload))
@@ -80,7 +90,14 @@ class application:
                     self.fvars = mod.__dict__
                     self.mapping = mapping
 
-            self.add_processor(loadhook(Reloader()))
+            reloader = Reloader()
+            def reload_modules():
+                """loadhook to reload changed modules."""
+                if reloader():
+                    # cached handlers may refer to classes of old modules.
+                    self._handlers = None
+
+            self.add_processor(loadhook(reload_modules))
             if mapping_name and module_name:
                 self.add_processor(loadhook(reload_mapping))
 
@@ -107,18 +124,28 @@ class application:
                 web.ctx.fullpath = oldctx.fullpath
                 
     def _cleanup(self):
-        #@@@
         # Since the CherryPy Webserver uses thread pool, the thread-local state is never cleared.
         # This interferes with the other requests. 
-        # clearing the thread-local storage to avoid that.
+        # clearing the thread-local storage to avoid that, except for the
+        # persistent ones like the database connections.
         # see utils.ThreadedDict for details
-        import threading
-        t = threading.currentThread()
-        if hasattr(t, '_d'):
-            del t._d
+        utils.ThreadedDict.clear_all()
+    
+    def __setattr__(self, name, value):
+        if name == 'processors' and not (isinstance(value, _ProcessorList)
+                                         and value.changed == self._reset_chain):
+            # the processors are composed again whenever they change.
+            value = _ProcessorList(value, self._reset_chain)
+            self.__dict__['_chain'] = None
+        self.__dict__[name] = value
+    
+    def _reset_chain(self):
+        self._chain = None
     
     def add_mapping(self, pattern, classname):
         self.mapping += (pattern, classname)
+        # mapping may be a list that was extended in place.
+        self._routes = None
         
     def add_processor(self, processor):
         """
@@ -138,6 +165,32 @@ class application:
         """
         self.processors.append(processor)
 
+    def processor_timings(self):
+        """
+        Returns timings of the processors of this application as a list of
+        storage objects with `processor`, `calls`, `total` and `own` keys,
+        in the order the processors are applied. `own` excludes the time
+        spent in the inner processors and the handler. For processors returning
+        a generator, only the time until it is returned is counted.
+        
+        Timings are collected only when `web.config.processor_timing` is set.
+        
+            >>> urls = ("/hello", "hello")
+            >>> app = application(urls, globals(), autoreload=False)
+            >>> class hello:
+            ...     def GET(self): return "hello"
+            >>> web.config.processor_timing = True
+            >>> app.request("/hello").data
+            'hello'
+            >>> [t.calls for t in app.processor_timings()]
+            [1, 1]
+            >>> web.config.processor_timing = False
+        """
+        chain = getattr(self, '_chain', None)
+        if chain and chain.timings:
+            return [utils.storage(t) for t in chain.timings]
+        return []
+
     def request(self, localpart='/', method='GET', data=None,
                 host="0.0.0.0:8080", headers=None, https=False, **kw):
         """Makes request to this application for the specified path and method.
@@ -221,7 +274,11 @@ class application:
             response.status = status
             response.headers = dict(headers)
             response.header_items = headers
-        response.data = "".join(self.wsgifunc()(env, start_response))
+        result = self.wsgifunc()(env, start_response)
+        try:
+            response.data = "".join(result)
+        finally:
+            result.close()
         return response
 
     def browser(self):
@@ -233,23 +290,65 @@ class application:
         return self._delegate(fn, self.fvars, args)
         
     def handle_with_processors(self):
-        def process(processors):
-            try:
-                if processors:
-                    p, processors = processors[0], processors[1:]
-                    return p(lambda: process(processors))
-                else:
-                    return self.handle()
-            except web.HTTPError:
-                raise
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except:
-                print >> web.debug, traceback.format_exc()
-                raise self.internalerror()
-        
-        # processors must be applied in the resvere order. (??)
-        return process(self.processors)
+        chain = getattr(self, '_chain', None)
+        if chain is None:
+            # reset when the processors or `web.config.processor_timing` change.
+            timing = bool(web.config.get('processor_timing'))
+            chain = self._chain = self._compose_processors(timing)
+        return chain.handler()
+
+    def _compose_processors(self, timing=False):
+        """Nests the processors around `handle` into a single callable.
+        Every level passes HTTPError through and turns other exceptions into
+        `internalerror`.
+        """
+        def guard(f):
+            def guarded():
+                try:
+                    return f()
+                except web.HTTPError:
+                    raise
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    print >> web.debug, traceback.format_exc()
+                    raise self.internalerror()
+            return guarded
+
+        def link(p, handler):
+            return lambda: p(handler)
+
+        def timed_link(p, handler, stats):
+            def f():
+                inner = [0.0]
+                def timed_handler():
+                    start = time.time()
+                    try:
+                        return handler()
+                    finally:
+                        inner[0] += time.time() - start
+                        
+                start = time.time()
+                try:
+                    return p(timed_handler)
+                finally:
+                    total = time.time() - start
+                    stats.calls += 1
+                    stats.total += total
+                    stats.own += total - inner[0]
+            return f
+
+        timings = []
+        handler = guard(lambda: self.handle())
+        for p in reversed(self.processors):
+            if timing:
+                name = getattr(p, '__name__', None) or repr(p)
+                stats = utils.storage(processor=name, calls=0, total=0.0, own=0.0)
+                timings.insert(0, stats)
+                handler = guard(timed_link(p, handler, stats))
+            else:
+                handler = guard(link(p, handler))
+        return utils.storage(timing=timing, timings=timings, handler=handler)
                         
     def wsgifunc(self, *middleware):
         """Returns a WSGI-compatible function for this application."""
@@ -263,7 +362,7 @@ class application:
             try:
                 firstchunk = iterator.next()
             except StopIteration:
-                firstchunk = ''
+                return iter([])
 
             return itertools.chain([firstchunk], iterator)    
                                 
@@ -281,28 +380,42 @@ class application:
 
                 result = self.handle_with_processors()
                 if is_generator(result):
-                    result = peep(result)
+                    result = _StreamingResponse(web.utf8(peep(result)), result, self._cleanup)
                 else:
-                    result = [result]
+                    result = _Response([web.utf8(result)], self._cleanup)
             except web.HTTPError, e:
-                result = [e.data]
+                result = _Response([web.utf8(e.data)], self._cleanup)
 
-            result = web.utf8(iter(result))
+            if isinstance(result, _Response):
+                self._finalize(result)
 
-            status, headers = web.ctx.status, web.ctx.headers
+            status, headers = web.ctx.status, list(web.ctx.headers)
             start_resp(status, headers)
-            
-            def cleanup():
-                self._cleanup()
-                yield '' # force this function to be a generator
-                            
-            return itertools.chain(result, cleanup())
+            return result
 
         for m in middleware: 
             wsgi = m(wsgi)
 
         return wsgi
 
+    def _finalize(self, result):
+        """Adds `Content-Length` and `ETag` headers to a response whose whole 
+        body is known, when enabled by `web.config.content_length` and 
+        `web.config.etag`. A request with a matching `If-None-Match` header 
+        gets `304 Not Modified` instead.
+        """
+        if (web.config.get('etag') and web.ctx.status.startswith('200 ')
+            and web.ctx.method in ('GET', 'HEAD') and not web._has_header('ETag')):
+            try:
+                http.modified(etag=md5(result[0]).hexdigest())
+            except web.NotModified:
+                result[:] = ['']
+
+        if web.config.get('content_length'):
+            status = int(web.ctx.status[:3])
+            if status >= 200 and status not in (204, 205, 304):
+                web.header('Content-Length', str(len(result[0])), unique=True)
+
     def run(self, *middleware):
         """
         Starts handling requests. If called in a CGI or FastCGI context, it will follow
@@ -332,79 +445,93 @@ class application:
             return wsgiref.handlers.CGIHandler().run(wsgiapp)
     
     def load(self, env):
-        """Initializes ctx using env."""
+        """Initializes ctx using env.
+        
+        The request fields derived from env, like `home`, `path` or `fullpath`,
+        are computed when they are first accessed.
+        """
         ctx = web.ctx
         ctx.clear()
+        # status must always be str
         ctx.status = '200 OK'
-        ctx.headers = []
-        ctx.output = ''
+        ctx.headers = web._Headers()
+        ctx.output = u''
         ctx.environ = ctx.env = env
-        ctx.host = env.get('HTTP_HOST')
+        ctx.app_stack = []
 
-        if env.get('wsgi.url_scheme') in ['http', 'https']:
-            ctx.protocol = env['wsgi.url_scheme']
-        elif env.get('HTTPS', '').lower() in ['on', 'true', '1']:
-            ctx.protocol = 'https'
-        else:
-            ctx.protocol = 'http'
-        ctx.homedomain = ctx.protocol + '://' + env.get('HTTP_HOST', '[unknown]')
-        ctx.homepath = os.environ.get('REAL_SCRIPT_NAME', env.get('SCRIPT_NAME', ''))
-        ctx.home = ctx.homedomain + ctx.homepath
-        #@@ home is changed when the request is handled to a sub-application.
-        #@@ but the real home is required for doing absolute redirects.
-        ctx.realhome = ctx.home
-        ctx.ip = env.get('REMOTE_ADDR')
-        ctx.method = env.get('REQUEST_METHOD')
-        ctx.path = env.get('PATH_INFO')
-        # http://trac.lighttpd.net/trac/ticket/406 requires:
-        if env.get('SERVER_SOFTWARE', '').startswith('lighttpd/'):
-            ctx.path = lstrips(env.get('REQUEST_URI').split('?')[0], ctx.homepath)
-            # Apache and CherryPy webservers unquote the url but lighttpd doesn't. 
-            # unquote explicitly for lighttpd to make ctx.path uniform across all servers.
-            ctx.path = urllib.unquote(ctx.path)
-
-        if env.get('QUERY_STRING'):
-            ctx.query = '?' + env.get('QUERY_STRING', '')
-        else:
-            ctx.query = ''
+    def _delegate(self, f, fvars, args=[]):
+        if f is None:
+            raise web.notfound()
+        return self._get_handler(f, fvars)(args)
 
-        ctx.fullpath = ctx.path + ctx.query
+    def _get_handler(self, f, fvars):
+        """Returns a callable taking the matched args that handles the request
+        for the mapping target `f`.
         
-        for k, v in ctx.iteritems():
-            if isinstance(v, str):
-                ctx[k] = safeunicode(v)
+        Handlers of the targets in the mapping are cached. The cache is
+        dropped when the mapping or fvars change or when the autoreloader
+        reloads a module.
+        """
+        handlers = getattr(self, '_handlers', None)
+        if handlers is None or handlers.mapping is not self.mapping or handlers.fvars is not fvars:
+            targets = set()
+            for pat, what in utils.group(self.mapping, 2):
+                try:
+                    targets.add(what)
+                except TypeError:
+                    pass # unhashable
+            handlers = self._handlers = web.storage(mapping=self.mapping, fvars=fvars, targets=targets, cache={})
 
-        # status must always be str
-        ctx.status = '200 OK'
+        try:
+            return handlers.cache[f]
+        except (KeyError, TypeError):
+            pass
         
-        ctx.app_stack = []
-
-    def _delegate(self, f, fvars, args=[]):
+        handler = self._prepare_handler(f, fvars)
+        try:
+            # only cache targets from the mapping, not ones computed for
+            # a request like expanded redirects or sub-application hooks.
+            if f in handlers.targets:
+                handlers.cache[f] = handler
+        except TypeError:
+            pass
+        return handler
+
+    def _prepare_handler(self, f, fvars):
         def handle_class(cls):
-            meth = web.ctx.method
-            if meth == 'HEAD' and not hasattr(cls, meth):
-                meth = 'GET'
-            if not hasattr(cls, meth):
-                raise web.nomethod(cls)
-            tocall = getattr(cls(), meth)
-            return tocall(*args)
+            verbs = {}
+            def handle(args):
+                meth = web.ctx.method
+                name = verbs.get(meth)
+                if name is None:
+                    name = meth
+                    if meth == 'HEAD' and not hasattr(cls, meth):
+                        name = 'GET'
+                    if not hasattr(cls, name):
+                        raise web.nomethod(cls)
+                    verbs[meth] = name
+                tocall = getattr(cls(), name)
+                return tocall(*args)
+            return handle
+            
+        def handle_redirect(url):
+            def handle(args):
+                if web.ctx.method == "GET":
+                    x = web.ctx.env.get('QUERY_STRING', '')
+                    if x:
+                        raise web.redirect(url + '?' + x)
+                raise web.redirect(url)
+            return handle
             
         def is_class(o): return isinstance(o, (types.ClassType, type))
             
-        if f is None:
-            raise web.notfound()
-        elif isinstance(f, application):
-            return f.handle_with_processors()
+        if isinstance(f, application):
+            return lambda args: f.handle_with_processors()
         elif is_class(f):
             return handle_class(f)
         elif isinstance(f, basestring):
             if f.startswith('redirect '):
-                url = f.split(' ', 1)[1]
-                if web.ctx.method == "GET":
-                    x = web.ctx.env.get('QUERY_STRING', '')
-                    if x:
-                        url += '?' + x
-                raise web.redirect(url)
+                return handle_redirect(f.split(' ', 1)[1])
             elif '.' in f:
                 x = f.split('.')
                 mod, cls = '.'.join(x[:-1]), x[-1]
@@ -414,27 +541,25 @@ class application:
                 cls = fvars[f]
             return handle_class(cls)
         elif hasattr(f, '__call__'):
-            return f()
+            return lambda args: f()
         else:
-            return web.notfound()
+            return lambda args: web.notfound()
 
     def _match(self, mapping, value):
-        for pat, what in utils.group(mapping, 2):
-            if isinstance(what, application):
-                if value.startswith(pat):
-                    f = lambda: self._delegate_sub_application(pat, what)
-                    return f, None
-                else:
-                    continue
-            elif isinstance(what, basestring):
-                what, result = utils.re_subm('^' + pat + '$', what, value)
-            else:
-                result = utils.re_compile('^' + pat + '$').match(value)
-                
-            if result: # it's a match
-                return what, [x for x in result.groups()]
-        return None, None
+        return self._get_routes(mapping).match(value)
+
+    def _get_routes(self, mapping, mounts=True):
+        """Returns the compiled route table for `mapping`.
         
+        The table is rebuilt whenever a different mapping object is passed,
+        which is what happens when the autoreloader swaps `self.mapping`.
+        `add_mapping` resets it explicitly.
+        """
+        routes = getattr(self, '_routes', None)
+        if routes is None or routes.mapping is not mapping:
+            routes = self._routes = _RouteTable(mapping, self, mounts=mounts)
+        return routes
+
     def _delegate_sub_application(self, dir, app):
         """Deletes request to sub application `app` rooted at the directory `dir`.
         The home, homepath, path and fullpath values in web.ctx are updated to mimic request
@@ -442,7 +567,9 @@ class application:
         
         @@Any issues with when used with yield?
         """
-        web.ctx._oldctx = web.storage(web.ctx)
+        ctx = web.ctx
+        web.ctx._oldctx = web.storage(ctx, home=ctx.home, homepath=ctx.homepath, 
+            path=ctx.path, fullpath=ctx.fullpath)
         web.ctx.home += dir
         web.ctx.homepath += dir
         web.ctx.path = web.ctx.path[len(dir):]
@@ -512,6 +639,38 @@ class auto_application(application):
 # The application class already has the required functionality of subdir_application
 subdir_application = application
                 
+class _Response(list):
+    """
+    Response body returned by `application.wsgifunc` when the whole body is 
+    known. It is a one element list, so that servers can send it with a 
+    Content-Length. The request is cleaned up when the server closes it.
+    """
+    def __init__(self, chunks, cleanup):
+        list.__init__(self, chunks)
+        self._cleanup = cleanup
+
+    def close(self):
+        self._cleanup()
+
+class _StreamingResponse:
+    """Response body returned by `application.wsgifunc` for handlers that 
+    return a generator.
+    """
+    def __init__(self, iterator, generator, cleanup):
+        self.iterator = iterator
+        self.generator = generator
+        self._cleanup = cleanup
+
+    def __iter__(self):
+        return iter(self.iterator)
+
+    def close(self):
+        try:
+            if hasattr(self.generator, 'close'):
+                self.generator.close()
+        finally:
+            self._cleanup()
+
 class subdomain_application(application):
     """
     Application to delegate requests based on the host.
@@ -537,8 +696,140 @@ class subdomain_application(application):
         return self._delegate(fn, self.fvars, args)
         
     def _match(self, mapping, value):
-        for pat, what in utils.group(mapping, 2):
-            if isinstance(what, basestring):
+        return self._get_routes(mapping, mounts=False).match(value)
+        
+class _RouteTable:
+    """URL mapping compiled for dispatch.
+
+    Matching a value returns the same `(what, groups)` pair as trying each
+    `'^' + pattern + '$'` of the mapping in order, but literal patterns
+    are looked up in a dict, sub-application mounts in a prefix trie and
+    all other patterns are tried at once as alternations of a combined
+    regular expression. The first matching pattern in mapping order wins.
+
+        >>> class app:
+        ...     def _delegate_sub_application(self, dir, app): pass
+        >>> t = _RouteTable(("/", "index", "/hello/(.*)", "hello", "/(.*)", "page"), app())
+        >>> t.match("/")
+        ('index', [])
+        >>> t.match("/hello/world")
+        ('hello', ['world'])
+        >>> t.match("/foo")
+        ('page', ['foo'])
+    """
+    # python's re module refuses patterns with more than 100 groups.
+    MAX_GROUPS = 100
+
+    r_literal = re.compile(r'^[^\\.^$*+?{}\[\]|()]*$')
+    # named groups, inline flags, conditionals and backreferences
+    # can't be moved into a combined pattern.
+    r_uncombinable = re.compile(r'\(\?[^:=!<#]|\(\?<[^=!]|\\[0-9]')
+
+    def __init__(self, mapping, app, mounts=True):
+        self.mapping = mapping
+        self.app = app
+        self.mounts = mounts
+        self.entries = [(pat, what) for pat, what in utils.group(mapping, 2)]
+        self.static = {}
+        self.trie = {}
+        self.patterns = []
+        self.slow = []
+
+        chunk, groups = [], 0
+        for i, (pat, what) in enumerate(self.entries):
+            if mounts and isinstance(what, application):
+                node = self.trie
+                for c in pat:
+                    node = node.setdefault(c, {})
+                node.setdefault(None, i)
+                continue
+
+            # targets like r"redirect /hello/\1" are expanded by re_subm,
+            # which also finds matches of top-level alternations anywhere.
+            if isinstance(what, basestring) and ('\\' in what or '|' in pat):
+                self.slow.append(i)
+                continue
+
+            if self.r_literal.match(pat):
+                self.static.setdefault(pat, i)
+                continue
+
+            try:
+                ngroups = re.compile('^' + pat + '$').groups
+            except re.error:
+                ngroups = None
+            if ngroups is None or self.r_uncombinable.search(pat) or ngroups + 1 > self.MAX_GROUPS:
+                self.slow.append(i)
+                continue
+
+            if groups + ngroups + 1 > self.MAX_GROUPS:
+                self._add_chunk(chunk)
+                chunk, groups = [], 0
+            chunk.append((i, groups + 1, ngroups))
+            groups += ngroups + 1
+        self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk):
+        if not chunk:
+            return
+        regex = '|'.join(['(?P<r%d>^%s$)' % (i, self.entries[i][0]) for i, offset, n in chunk])
+        index = dict([('r%d' % i, (i, offset, n)) for i, offset, n in chunk])
+        self.patterns.append((chunk[0][0], re.compile(regex), index))
+
+    def match(self, value):
+        """Returns `(what, groups)` for the first pattern matching `value`."""
+        if value.endswith('\n'):
+            # '$' also matches before a trailing newline, which a dict lookup can't mimic.
+            return self._match_entries(value, xrange(len(self.entries)))
+
+        best = self.static.get(value, len(self.entries))
+        groups = []
+
+        node = self.trie
+        if None in node:
+            best = min(best, node[None])
+        for c in value:
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node and node[None] < best:
+                best = node[None]
+
+        for first, regex, index in self.patterns:
+            if first >= best:
+                break
+            m = regex.match(value)
+            if m:
+                i, offset, n = index[m.lastgroup]
+                if i < best:
+                    best = i
+                    groups = list(m.groups()[offset:offset+n])
+                break
+
+        slow = [i for i in self.slow if i < best]
+        if slow:
+            what, result = self._match_entries(value, slow)
+            if what is not None or result is not None:
+                return what, result
+
+        if best == len(self.entries):
+            return None, None
+
+        pat, what = self.entries[best]
+        if self.mounts and isinstance(what, application):
+            return lambda: self.app._delegate_sub_application(pat, what), None
+        return what, groups
+
+    def _match_entries(self, value, indexes):
+        """Tries the patterns at `indexes` one by one."""
+        for i in indexes:
+            pat, what = self.entries[i]
+            if self.mounts and isinstance(what, application):
+                if value.startswith(pat):
+                    return lambda: self.app._delegate_sub_application(pat, what), None
+                else:
+                    continue
+            elif isinstance(what, basestring):
                 what, result = utils.re_subm('^' + pat + '$', what, value)
             else:
                 result = utils.re_compile('^' + pat + '$').match(value)
@@ -546,7 +837,7 @@ class subdomain_application(application):
             if result: # it's a match
                 return what, [x for x in result.groups()]
         return None, None
-        
+
 def loadhook(h):
     """
     Converts a load hook into an application processor.
@@ -637,6 +928,36 @@ def autodelegate(prefix=''):
             raise web.notfound()
     return internal
 
+class _ProcessorList(list):
+    """List of processors which calls `changed()` whenever it is modified."""
+    def __init__(self, processors, changed):
+        list.__init__(self, processors)
+        self.changed = changed
+
+    def _modifier(name):
+        method = getattr(list, name)
+        def f(self, *args):
+            result = method(self, *args)
+            self.changed()
+            return result
+        f.__name__ = name
+        return f
+
+    for name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__', 
+                 '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop', 
+                 'remove', 'reverse', 'sort'):
+        locals()[name] = _modifier(name)
+    del name, _modifier
+
+# applications whose processors are composed with timing when it is enabled.
+_applications = weakref.WeakKeyDictionary()
+
+def _reset_chains():
+    for app in _applications.keys():
+        app._reset_chain()
+
+web.config.watch('processor_timing', _reset_chains)
+
 class Reloader:
     """Checks to see if any loaded modules have changed on disk and, 
     if so, reloads them.
@@ -645,14 +966,17 @@ class Reloader:
         self.mtimes = {}
 
     def __call__(self):
+        """Returns True if any module has been reloaded."""
+        reloaded = False
         for mod in sys.modules.values():
-            self.check(mod)
+            reloaded = self.check(mod) or reloaded
+        return reloaded
             
     def check(self, mod):
         try: 
             mtime = os.stat(mod.__file__).st_mtime
         except (AttributeError, OSError, IOError):
-            return
+            return False
         if mod.__file__.endswith('.pyc') and os.path.exists(mod.__file__[:-1]):
             mtime = max(os.stat(mod.__file__[:-1]).st_mtime, mtime)
             
@@ -662,8 +986,10 @@ class Reloader:
             try: 
                 reload(mod)
                 self.mtimes[mod] = mtime
+                return True
             except ImportError: 
                 pass
+        return False
                 
 if __name__ == "__main__":
     import doctest
@@ -449,6 +449,27 @@ class Transaction:
             self.engine.do_rollback()
             self.ctx.transactions = self.ctx.transactions[:self.transaction_count]
 
+class _DBContext(threadeddict):
+    """Context of a `DB` in the current thread. The connection is kept 
+    across requests, but the transactions left open by a request are 
+    rolled back after it.
+    """
+    def __init__(self):
+        threadeddict.__init__(self, persistent=True)
+
+    def _clear(self):
+        ctx = getattr(self.__dict__['_local'], 'd', None)
+        if ctx is None:
+            return
+        if ctx.get('transactions'):
+            try:
+                ctx.transactions[0].rollback()
+            except:
+                # the connection can't be trusted anymore, get a new one.
+                ctx.pop('db', None)
+            ctx.transactions = []
+        ctx.dbq_count = 0
+
 class DB: 
     """Database"""
     def __init__(self, db_module, keywords):
@@ -462,7 +483,8 @@ class DB:
         self.keywords = keywords
 
         
-        self._ctx = threadeddict()
+        # connections are kept across requests handled by the same thread.
+        self._ctx = _DBContext()
         # flag to enable/disable printing queries
         self.printing = config.get('debug', False)
         self.supports_multiple_insert = False
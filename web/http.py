@@ -65,7 +65,13 @@ def modified(date=None, etag=None):
         # for python 2.3
         from sets import Set as set
 
-    n = set([x.strip('" ') for x in web.ctx.env.get('HTTP_IF_NONE_MATCH', '').split(',')])
+    n = set()
+    for x in web.ctx.env.get('HTTP_IF_NONE_MATCH', '').split(','):
+        x = x.strip()
+        if x.startswith('W/'):
+            # weak comparison, see GzipMiddleware
+            x = x[2:]
+        n.add(x.strip('"'))
     m = net.parsehttpdate(web.ctx.env.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
     validate = False
     if etag:
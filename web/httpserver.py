@@ -1,7 +1,8 @@
-__all__ = ["runsimple"]
+__all__ = ["runsimple", "runprefork", "GzipMiddleware"]
 
-import sys, os
+import sys, os, stat, time, datetime, binascii, zlib, itertools, threading
 from SimpleHTTPServer import SimpleHTTPRequestHandler
+from wsgiref.util import FileWrapper
 
 import webapi as web
 import net
@@ -136,7 +137,7 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
 
     [cp]: http://www.cherrypy.org
     """
-    func = StaticMiddleware(func)
+    func = StaticMiddleware(func, cache_size=web.config.get('static_cache_size', 0))
     func = LogMiddleware(func)
     
     server = WSGIServer(server_address, func)
@@ -147,6 +148,38 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
     except KeyboardInterrupt:
         server.stop()
 
+def runprefork(func, server_address=("0.0.0.0", 8080), workers=None):
+    """
+    Runs [CherryPy][cp] WSGI server hosting WSGI app `func` in `workers` 
+    processes (by default, one per CPU). The directory `static/` is hosted 
+    statically.
+    
+    Sending SIGHUP to the main process starts the program again, with the 
+    same arguments and listening socket, and then replaces the old worker 
+    processes one at a time, so that all the code (including that of the 
+    main script) is reloaded.
+
+    [cp]: http://www.cherrypy.org
+    """
+    from wsgiserver import PreforkServer
+    
+    func = StaticMiddleware(func, cache_size=web.config.get('static_cache_size', 0))
+    func = LogMiddleware(func)
+    
+    if not workers:
+        workers = _cpu_count()
+    server = WSGIServer(server_address, func)
+
+    print "http://%s:%d/" % server_address, "(%d processes)" % workers
+    PreforkServer(server, workers, reexec=True).start()
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
 def WSGIServer(server_address, wsgi_app):
     """Creates CherryPy WSGI server listening at `server_address` to serve `wsgi_app`.
     This function can be overwritten to customize the webserver or use a different webserver.
@@ -155,11 +188,15 @@ def WSGIServer(server_address, wsgi_app):
     return CherryPyWSGIServer(server_address, wsgi_app, server_name="localhost")
 
 class StaticApp(SimpleHTTPRequestHandler):
-    """WSGI application for serving static files."""
-    def __init__(self, environ, start_response):
+    """WSGI application for serving static files.
+    
+    `filename` is the file the request path translates to, if already known.
+    """
+    def __init__(self, environ, start_response, filename=None):
         self.headers = []
         self.environ = environ
         self.start_response = start_response
+        self.filename = filename
 
     def send_response(self, status, msg=""):
         self.status = str(status) + " " + msg
@@ -172,7 +209,21 @@ class StaticApp(SimpleHTTPRequestHandler):
 
     def log_message(*a): pass
 
+    def translate_path(self, path):
+        # the request path is translated once per request
+        if self.filename is None:
+            self.filename = SimpleHTTPRequestHandler.translate_path(self, path)
+        return self.filename
+
     def __iter__(self):
+        return iter(self.respond())
+
+    def respond(self):
+        """Starts the response and returns its body.
+
+        Files are returned in a `wsgi.file_wrapper`, so that the server 
+        can send them the fastest way it knows.
+        """
         environ = self.environ
 
         self.path = environ.get('PATH_INFO', '')
@@ -183,45 +234,329 @@ class StaticApp(SimpleHTTPRequestHandler):
         from cStringIO import StringIO
         self.wfile = StringIO() # for capturing error
 
+        gzpath = mtime = None
         try:
             path = self.translate_path(self.path)
-            etag = '"%s"' % os.path.getmtime(path)
-            client_etag = environ.get('HTTP_IF_NONE_MATCH')
+            mtime = os.path.getmtime(path)
+            etag = '"%s"' % mtime
+            if os.path.isfile(path + '.gz') and os.path.getmtime(path + '.gz') >= mtime:
+                # a precompressed copy of the file is available
+                self.send_header('Vary', 'Accept-Encoding')
+                if _negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), ['gzip']):
+                    gzpath = path + '.gz'
+                    etag = '"%s-gzip"' % mtime
             self.send_header('ETag', etag)
-            if etag == client_etag:
+            if _not_modified(environ, etag, mtime):
                 self.send_response(304, "Not Modified")
                 self.start_response(self.status, self.headers)
-                raise StopIteration
+                return []
         except OSError:
             pass # Probably a 404
 
-        f = self.send_head()
-        self.start_response(self.status, self.headers)
+        if gzpath:
+            f = self.send_head_gzip(path, gzpath)
+        else:
+            f = self.send_head()
 
         if f:
-            block_size = 16 * 1024
-            while True:
-                buf = f.read(block_size)
-                if not buf:
-                    break
-                yield buf
-            f.close()
+            self.send_header('Accept-Ranges', 'bytes')
+            if mtime is not None:
+                size = os.fstat(f.fileno())[6]
+                ranges = _requested_ranges(environ, etag, mtime, size)
+                if ranges is not None:
+                    return self.send_ranges(f, ranges, size)
+            self.start_response(self.status, self.headers)
+            if environ.get('REQUEST_METHOD') == 'HEAD':
+                f.close()
+                return []
+            file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+            return file_wrapper(f, 16 * 1024)
         else:
-            value = self.wfile.getvalue()
-            yield value
+            self.start_response(self.status, self.headers)
+            return [self.wfile.getvalue()]
+
+    def send_ranges(self, f, ranges, size):
+        """Starts the response with the `ranges` of the open file `f` of 
+        `size` bytes and returns its body.
+        """
+        status, headers, parts = _ranges_response(self.headers, ranges, size)
+        self.start_response(status, headers)
+        if len(parts) == 1:
+            # a single range can still be sent with the file wrapper
+            start, end = parts[0]
+            f.seek(start)
+            file_wrapper = self.environ.get('wsgi.file_wrapper', FileWrapper)
+            return file_wrapper(_FileRange(f, end - start + 1), 16 * 1024)
+        return _FileParts(f, parts)
+
+    def send_head_gzip(self, path, gzpath):
+        """Sends the headers for serving the precompressed copy `gzpath` 
+        of the file at `path` and returns it opened.
+        """
+        try:
+            f = open(gzpath, 'rb')
+        except IOError:
+            return self.send_head()
+        self.send_response(200, "OK")
+        self.send_header("Content-type", self.guess_type(path))
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(os.fstat(f.fileno())[6]))
+        self.send_header("Last-Modified", self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+        return f
+
+class _FileRange:
+    """The next `length` bytes of the open file `f`."""
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+        self.fileno, self.tell, self.close = f.fileno, f.tell, f.close
+
+    def read(self, size):
+        data = self.f.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+class _FileParts:
+    """Response body made of the `parts` returned by `_ranges_response`, 
+    with the ranges read from the open file `f`.
+    """
+    def __init__(self, f, parts):
+        self.f = f
+        self.parts = parts
+        self.close = f.close
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, str):
+                yield part
+                continue
+            start, end = part
+            self.f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = self.f.read(min(remaining, 16 * 1024))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
 
 class StaticMiddleware:
-    """WSGI middleware for serving static files."""
-    def __init__(self, app, prefix='/static/'):
+    """WSGI middleware for serving static files.
+    
+    When `cache_size` is given, files of at most `cache_max_file_size` 
+    bytes are kept in memory, up to `cache_size` bytes in all, and served 
+    without touching the disk. A cached file is checked for changes at 
+    most once every `cache_check_interval` seconds. Paths which can't be 
+    cached (missing, unreadable or larger files) are remembered as well, 
+    and checked as often, so that they go straight to `StaticApp`.
+    """
+    def __init__(self, app, prefix='/static/', cache_size=0, 
+                 cache_max_file_size=64 * 1024, cache_check_interval=1):
         self.app = app
         self.prefix = prefix
+        self.cache = None
+        if cache_size:
+            self.cache = _StaticCache(cache_size, cache_max_file_size, cache_check_interval)
         
     def __call__(self, environ, start_response):
         path = environ.get('PATH_INFO', '')
         if path.startswith(self.prefix):
-            return StaticApp(environ, start_response)
+            if self.cache is not None:
+                entry = self.cache.get(path)
+                if entry.identity is not None:
+                    return entry.respond(environ, start_response)
+                return StaticApp(environ, start_response, entry.filename).respond()
+            return StaticApp(environ, start_response).respond()
         else:
             return self.app(environ, start_response)
+
+class _StaticCache:
+    """Least recently used static files, for `StaticMiddleware`.
+    
+    Up to `max_misses` paths which can't be cached are remembered too, 
+    as entries without a body.
+    """
+    max_misses = 1024
+
+    def __init__(self, max_size, max_file_size, check_interval):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = {}
+        self.misses = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def get(self, path):
+        """Returns the cached file for `path`, loading it if needed. Its 
+        `identity` is None if it can't be cached.
+        """
+        entry = self.entries.get(path) or self.misses.get(path)
+        if entry is not None:
+            entry.used = self.counter.next()
+            now = time.time()
+            if now - entry.checked < self.check_interval:
+                return entry
+            if entry.stat() == entry.signature:
+                entry.checked = now
+                return entry
+            self.remove(path, entry)
+            filename = entry.filename
+        else:
+            filename = StaticApp({}, None).translate_path(path)
+
+        entry = self.load(filename)
+        if entry.identity is not None:
+            self.add(path, entry)
+        else:
+            self.add_miss(path, entry)
+        return entry
+
+    def load(self, filename):
+        entry = _CachedFile(filename)
+        signature = entry.signature = entry.stat()
+        entry.checked = time.time()
+        entry.used = self.counter.next()
+        if signature is None or signature[1] > self.max_file_size:
+            return entry
+
+        try:
+            f = open(filename, 'rb')
+            try:
+                body = f.read(self.max_file_size + 1)
+            finally:
+                f.close()
+            gzbody = None
+            if signature[2] is not None and signature[2] >= signature[0]:
+                # a precompressed copy of the file is available
+                f = open(filename + '.gz', 'rb')
+                try:
+                    gzbody = f.read(self.max_file_size + 1)
+                finally:
+                    f.close()
+                if len(gzbody) > self.max_file_size:
+                    return entry
+        except IOError:
+            return entry
+        if len(body) > self.max_file_size or entry.stat() != signature:
+            # changed while being read: check again next time
+            entry.checked = 0
+            return entry
+
+        mtime = signature[0]
+        app = StaticApp({}, None, filename)
+        headers = [('Content-type', app.guess_type(filename)),
+                   ('Last-Modified', app.date_time_string(mtime)),
+                   ('Accept-Ranges', 'bytes')]
+        vary = []
+        if gzbody is not None:
+            vary = [('Vary', 'Accept-Encoding')]
+            entry.gzip = _CachedBody(gzbody, '"%s-gzip"' % mtime, vary, 
+                headers + [('Content-Encoding', 'gzip')])
+        entry.identity = _CachedBody(body, '"%s"' % mtime, vary, headers)
+        return entry
+
+    def add(self, path, entry):
+        self.lock.acquire()
+        try:
+            old = self.entries.get(path)
+            if old is not None:
+                self.size -= old.size()
+            self.entries[path] = entry
+            self.size += entry.size()
+            if self.size > self.max_size:
+                # drop the least recently used files
+                for used, p in sorted([(e.used, p) for p, e in self.entries.items()]):
+                    if self.size <= self.max_size:
+                        break
+                    self.size -= self.entries.pop(p).size()
+        finally:
+            self.lock.release()
+
+    def add_miss(self, path, entry):
+        self.lock.acquire()
+        try:
+            if path not in self.misses and len(self.misses) >= self.max_misses:
+                self.misses.popitem()
+            self.misses[path] = entry
+        finally:
+            self.lock.release()
+
+    def remove(self, path, entry):
+        self.lock.acquire()
+        try:
+            if self.entries.get(path) is entry:
+                del self.entries[path]
+                self.size -= entry.size()
+            elif self.misses.get(path) is entry:
+                del self.misses[path]
+        finally:
+            self.lock.release()
+
+class _CachedFile:
+    """A static file kept in memory by `_StaticCache`."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.identity = self.gzip = None
+
+    def stat(self):
+        """Returns the modification time and size of the file and the 
+        modification time of its precompressed copy (or None), or None 
+        if it isn't a regular file.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        try:
+            gzmtime = os.path.getmtime(self.filename + '.gz')
+        except OSError:
+            gzmtime = None
+        return st.st_mtime, st.st_size, gzmtime
+
+    def size(self):
+        size = len(self.identity.body)
+        if self.gzip is not None:
+            size += len(self.gzip.body)
+        return size
+
+    def respond(self, environ, start_response):
+        """Same as `StaticApp.respond`, from memory."""
+        body = self.identity
+        if self.gzip is not None and \
+           _negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), ['gzip']):
+            body = self.gzip
+        mtime = self.signature[0]
+        if _not_modified(environ, body.etag, mtime):
+            start_response('304 Not Modified', body.headers_304[:])
+            return []
+
+        ranges = _requested_ranges(environ, body.etag, mtime, len(body.body))
+        if ranges is not None:
+            status, headers, parts = _ranges_response(body.headers, ranges, len(body.body))
+            start_response(status, headers)
+            for i, part in enumerate(parts):
+                if not isinstance(part, str):
+                    parts[i] = body.body[part[0]:part[1] + 1]
+            return [''.join(parts)]
+
+        start_response('200 OK', body.headers[:])
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [body.body]
+
+class _CachedBody:
+    """One encoding of a `_CachedFile`, with its response headers."""
+    def __init__(self, body, etag, vary, headers):
+        self.body = body
+        self.etag = etag
+        self.headers_304 = vary + [('ETag', etag)]
+        self.headers = self.headers_304 + headers[:1] + \
+            [('Content-Length', str(len(body)))] + headers[1:]
     
 class LogMiddleware:
     """WSGI middleware for logging the status."""
@@ -260,3 +595,355 @@ class LogMiddleware:
 
         msg = self.format % (host, time, protocol, method, req, status)
         print >> outfile, utils.safestr(msg)
+
+def _negotiate_encoding(accept_encoding, encodings=('gzip', 'deflate')):
+    """
+    Returns the first of `encodings` with the highest quality in the 
+    `Accept-Encoding` header `accept_encoding`, or None if none of them 
+    is acceptable.
+    
+        >>> _negotiate_encoding('gzip, deflate')
+        'gzip'
+        >>> _negotiate_encoding('gzip;q=0.5, deflate')
+        'deflate'
+        >>> _negotiate_encoding('*;q=0, identity')
+        >>> _negotiate_encoding('')
+    """
+    qvalues = {}
+    for part in accept_encoding.split(','):
+        params = part.split(';')
+        name = params[0].strip().lower()
+        q = 1.0
+        for p in params[1:]:
+            k, _, v = p.partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if name:
+            qvalues[name] = q
+
+    best, bestq = None, 0
+    for encoding in encodings:
+        q = qvalues.get(encoding, qvalues.get('x-' + encoding, qvalues.get('*', 0)))
+        if q > bestq:
+            best, bestq = encoding, q
+    return best
+
+def _etag_matches(if_none_match, etag):
+    """
+    Returns True if `etag` is one of the ETags in the `If-None-Match` 
+    header `if_none_match`. Weak ETags match too, as `GzipMiddleware` 
+    turns the ETags of the responses it compresses into weak ones.
+
+        >>> _etag_matches('"a", W/"b"', '"b"')
+        True
+        >>> _etag_matches('*', '"a"')
+        True
+        >>> _etag_matches('"a"', '"b"')
+        False
+    """
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+def _not_modified(environ, etag, mtime):
+    """Returns True if the client already has the version of a static file 
+    with the ETag `etag` and modification time `mtime`, according to the 
+    `If-None-Match` or else the `If-Modified-Since` header.
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    since = net.parsehttpdate(environ.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+    # HTTP dates don't have sub-second precision
+    return since is not None and datetime.datetime.utcfromtimestamp(int(mtime)) <= since
+
+def _parse_range(range_header, size):
+    """
+    Returns the first and last positions of the byte ranges asked for by 
+    the `Range` header `range_header`, in a body of `size` bytes. Returns 
+    None if the header is to be ignored and an empty list if none of the 
+    ranges are in the body.
+
+        >>> _parse_range('bytes=0-499', 1000)
+        [(0, 499)]
+        >>> _parse_range('bytes=500-, -100, 0-0', 1000)
+        [(500, 999), (900, 999), (0, 0)]
+        >>> _parse_range('bytes=900-1500', 1000)
+        [(900, 999)]
+        >>> _parse_range('bytes=1000-', 1000)
+        []
+        >>> _parse_range('bytes=5-1', 1000)
+        >>> _parse_range('lines=1-2', 1000)
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = size - 1
+                if last:
+                    end = int(last)
+                    if end < start:
+                        return None
+            else:
+                # the last `last` bytes
+                start = size - int(last)
+                end = size - 1
+        except ValueError:
+            return None
+        if start < 0:
+            start = 0
+        if start < size and start <= end:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > 16:
+        # not worth it, send the whole body
+        return None
+    return ranges
+
+def _requested_ranges(environ, etag, mtime, size):
+    """Returns the ranges of a static file with the ETag `etag`, modification
+    time `mtime` and `size` bytes to send, as `_parse_range`, or None to send 
+    all of it. The `If-Range` header is taken into account.
+    """
+    range_header = environ.get('HTTP_RANGE')
+    if not range_header or environ.get('REQUEST_METHOD') != 'GET':
+        return None
+    if_range = environ.get('HTTP_IF_RANGE', '').strip()
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != etag:
+                return None
+        elif net.parsehttpdate(if_range) != datetime.datetime.utcfromtimestamp(int(mtime)):
+            return None
+    return _parse_range(range_header, size)
+
+def _ranges_response(headers, ranges, size):
+    """
+    Returns the status, headers and body parts of the response sending the 
+    `ranges` of a static file of `size` bytes, sent as a whole with 
+    `headers`. Each part of the body is either a string or the first and 
+    last positions of a range of the file.
+
+        >>> _ranges_response([('Content-Length', '10')], [(2, 5)], 10)
+        ('206 Partial Content', [('Content-Range', 'bytes 2-5/10'), ('Content-Length', '4')], [(2, 5)])
+        >>> _ranges_response([('Content-Length', '10')], [], 10)
+        ('416 Requested Range Not Satisfiable', [('Content-Range', 'bytes */10'), ('Content-Length', '0')], [])
+    """
+    headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+    if not ranges:
+        headers += [('Content-Range', 'bytes */%d' % size), ('Content-Length', '0')]
+        return '416 Requested Range Not Satisfiable', headers, []
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers += [('Content-Range', 'bytes %d-%d/%d' % (start, end, size)), 
+                    ('Content-Length', str(end - start + 1))]
+        return '206 Partial Content', headers, [(start, end)]
+
+    content_type = 'application/octet-stream'
+    for k, v in headers:
+        if k.lower() == 'content-type':
+            content_type = v
+    headers = [(k, v) for k, v in headers if k.lower() != 'content-type']
+    boundary = binascii.hexlify(os.urandom(12))
+    parts = []
+    for start, end in ranges:
+        parts.append('\r\n--%s\r\nContent-type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' 
+                     % (boundary, content_type, start, end, size))
+        parts.append((start, end))
+    parts.append('\r\n--%s--\r\n' % boundary)
+    length = 0
+    for part in parts:
+        if isinstance(part, str):
+            length += len(part)
+        else:
+            length += part[1] - part[0] + 1
+    headers += [('Content-type', 'multipart/byteranges; boundary=' + boundary), 
+                ('Content-Length', str(length))]
+    return '206 Partial Content', headers, parts
+
+class GzipMiddleware:
+    """
+    WSGI middleware that compresses responses with gzip or deflate, 
+    as allowed by the `Accept-Encoding` header of the request.
+
+        app.run(web.GzipMiddleware)
+    
+    Responses smaller than `min_size` bytes, responses that already have a
+    `Content-Encoding` and responses whose content type matches 
+    `skip_types` are sent unchanged. Streaming responses are compressed 
+    chunk by chunk with a flush after each chunk, so that every chunk still
+    reaches the client when it is produced.
+    """
+    skip_types = ['image/', 'audio/', 'video/', 'application/zip', 'application/gzip',
+        'application/x-gzip', 'application/x-bzip2', 'application/x-compress',
+        'application/x-rar-compressed', 'application/x-7z-compressed', 'application/pdf',
+        'application/octet-stream']
+    
+    def __init__(self, app, min_size=512, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def compressible(self, content_type):
+        """Returns True if responses of type `content_type` are worth compressing."""
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type == 'image/svg+xml':
+            return True
+        for t in self.skip_types:
+            if content_type.startswith(t):
+                return False
+        return True
+
+    def compressor(self, encoding):
+        if encoding == 'gzip':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            return zlib.compressobj(self.level)
+
+    def __call__(self, environ, start_response):
+        encoding = None
+        if environ.get('REQUEST_METHOD') != 'HEAD':
+            encoding = _negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        response = _GzipResponse(self, encoding, start_response)
+        result = self.app(environ, response.start_response)
+
+        if isinstance(result, (list, tuple)) and response.status is not None:
+            # the whole body is known
+            encoding = response.choose(sum([len(chunk) for chunk in result]))
+            if encoding:
+                try:
+                    c = self.compressor(encoding)
+                    body = c.compress(''.join(result)) + c.flush()
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                response.begin(encoding, len(body))
+                return [body]
+            else:
+                response.begin(None)
+                return result
+        if response.status is not None and not response.choose():
+            # not compressed: leave the body (maybe a wsgi.file_wrapper) alone
+            response.begin(None)
+            return result
+        return _GzipStream(response, result)
+
+class _GzipResponse:
+    """Status and headers of a response going through `GzipMiddleware`."""
+    def __init__(self, middleware, encoding, start_response):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._start_response = start_response
+        self.status = self.headers = self.exc_info = None
+        self._write = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info and self._write is not None:
+            # the response has begun: the error can't be reported (PEP 333)
+            try:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        self.status, self.headers, self.exc_info = status, headers, exc_info
+        return self.write
+
+    def write(self, data):
+        # data given to write() can't be compressed, as the headers are sent first.
+        self.begin(None)
+        self._write(data)
+
+    def choose(self, size=None):
+        """Returns the encoding to use for the response, or None to send it unchanged."""
+        if self._write is not None:
+            return None
+        status = int(self.status[:3])
+        if status < 200 or status in (204, 206, 304):
+            return None
+
+        headers = dict([(k.lower(), v) for k, v in self.headers])
+        if 'content-encoding' in headers or not self.middleware.compressible(headers.get('content-type', '')):
+            return None
+
+        vary = headers.get('vary')
+        if vary is None:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary.lower():
+            self.headers = [(k, v) for k, v in self.headers if k.lower() != 'vary']
+            self.headers.append(('Vary', vary + ', Accept-Encoding'))
+
+        if size is None and 'content-length' in headers:
+            size = utils.intget(headers['content-length'])
+        if size is not None and size < self.middleware.min_size:
+            return None
+        return self.encoding
+
+    def begin(self, encoding, length=None):
+        """Starts the response, with headers changed for `encoding`."""
+        if self._write is not None:
+            return
+        headers = self.headers
+        if encoding:
+            headers = []
+            for k, v in self.headers:
+                if k.lower() == 'content-length':
+                    continue
+                elif k.lower() == 'etag' and not v.startswith('W/'):
+                    # the compressed body isn't byte-identical to the original one
+                    v = 'W/' + v
+                headers.append((k, v))
+            headers.append(('Content-Encoding', encoding))
+            if length is not None:
+                headers.append(('Content-Length', str(length)))
+        self._write = self._start_response(self.status, headers, self.exc_info)
+
+class _GzipStream:
+    """Streaming response body going through `GzipMiddleware`."""
+    def __init__(self, response, iterable):
+        self.response = response
+        self.iterable = iterable
+
+    def __iter__(self):
+        response = self.response
+        iterator = iter(self.iterable)
+        # the status and headers are known only after the first iteration
+        try:
+            first = [iterator.next()]
+        except StopIteration:
+            first = []
+
+        if response.status is None:
+            raise AssertionError("WSGI app returned without calling start_response.")
+        encoding = response.choose()
+        response.begin(encoding)
+        if not encoding:
+            for chunk in first:
+                yield chunk
+            for chunk in iterator:
+                yield chunk
+            return
+
+        c = response.middleware.compressor(encoding)
+        for chunk in first:
+            if chunk:
+                yield c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+        for chunk in iterator:
+            if chunk:
+                yield c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+        yield c.flush()
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
@@ -43,6 +43,7 @@ class Session(utils.ThreadedDict):
     """
 
     def __init__(self, app, store, initializer=None):
+        utils.ThreadedDict.__init__(self)
         self.__dict__['store'] = store
         self.__dict__['_initializer'] = initializer
         self.__dict__['_last_cleanup_time'] = 0
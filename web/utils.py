@@ -24,7 +24,7 @@ __all__ = [
   "nthstr", "cond",
   "CaptureStdout", "capturestdout", "Profile", "profile",
   "tryall",
-  "ThreadedDict", "threadeddict",
+  "ThreadedDict", "threadeddict", "local_backend",
   "autoassign",
   "to36",
   "safemarkdown",
@@ -34,7 +34,7 @@ __all__ = [
   "slugify"
 ]
 
-import re, sys, time, threading, itertools, traceback, os, cgi, glob
+import re, sys, time, threading, itertools, traceback, os, cgi, glob, weakref
 
 try:
     import subprocess
@@ -1165,7 +1165,37 @@ class ThreadedDict:
         >>> t.join()
         >>> d.x
         1
-    """
+
+    `factory` creates the storage object of each thread. It defaults to `storage`.
+    
+    `ThreadedDict.clear_all()` clears the storage of the current thread in 
+    every ThreadedDict, except the ones created with `persistent=True`.
+    The application calls it after every request. Persistent dicts keep 
+    long lived per-thread resources like database connections; subclasses 
+    can override `_clear` to reset part of them.
+
+        >>> p = ThreadedDict(persistent=True)
+        >>> p.x = 1
+        >>> ThreadedDict.clear_all()
+        >>> d.get('x'), p.x
+        (None, 1)
+
+    The storage is kept in `threading.local` objects. To keep it per greenlet
+    or per task instead, use `ThreadedDict.set_backend` with a class 
+    that behaves like `threading.local` (see `local_backend`).
+    """
+    backend = threading.local
+    _factory = storage
+    _persistent = False
+    _instances = {}
+
+    def __init__(self, factory=None, persistent=False):
+        if factory is not None:
+            self.__dict__['_factory'] = factory
+        if persistent:
+            self.__dict__['_persistent'] = True
+        self._setup()
+
     def __getattr__(self, key):
         return getattr(self._getd(), key)
 
@@ -1178,17 +1208,102 @@ class ThreadedDict:
     def __hash__(self): 
         return id(self)
 
+    def _setup(self):
+        local = self.__dict__['_local'] = self.backend()
+        # don't keep ThreadedDicts of discarded objects alive.
+        instances = ThreadedDict._instances
+        instances[id(self)] = weakref.ref(self, lambda r, key=id(self): instances.pop(key, None))
+        return local
+
     def _getd(self):
-        t = threading.currentThread()
-        if not hasattr(t, '_d'):
-            # using __dict__ of thread as thread local storage
-            t._d = {}
-
-        # there could be multiple instances of ThreadedDict.
-        # use self as key
-        if self not in t._d:
-            t._d[self] = storage()
-        return t._d[self]
+        try:
+            return self.__dict__['_local'].d
+        except AttributeError:
+            d = self.__dict__['_local'].d = self._factory()
+            return d
+        except KeyError:
+            # subclass that doesn't call ThreadedDict.__init__
+            self._setup()
+            return self._getd()
+
+    def _reset(self):
+        """Clears the storage of the current thread."""
+        local = self.__dict__.get('_local')
+        if local is not None and hasattr(local, 'd'):
+            del local.d
+
+    def _clear(self):
+        """Called by `clear_all` for the current thread."""
+        if not self._persistent:
+            self._reset()
+
+    def clear_all():
+        """Clears the storage of the current thread in all non-persistent ThreadedDicts."""
+        for ref in ThreadedDict._instances.values():
+            d = ref()
+            if d is not None:
+                d._clear()
+    clear_all = staticmethod(clear_all)
+
+    def set_backend(backend):
+        """Makes all ThreadedDicts keep their storage in instances of `backend`,
+        a class behaving like `threading.local`. Existing storage is dropped,
+        so this should be called before handling any requests.
+        """
+        ThreadedDict.backend = backend
+        for ref in ThreadedDict._instances.values():
+            d = ref()
+            if d is not None:
+                d.__dict__['_local'] = backend()
+    set_backend = staticmethod(set_backend)
+
+def local_backend(current):
+    """
+    Returns a class that behaves like `threading.local`, but keeps its 
+    attributes per value of `current()` instead of per thread. `current` must
+    return a hashable object that can be weakly referenced, like the current 
+    greenlet or task. The attributes are dropped with that object.
+
+        ThreadedDict.set_backend(local_backend(greenlet.getcurrent))
+
+        >>> class Task: pass
+        >>> task = Task()
+        >>> local = local_backend(lambda: task)()
+        >>> local.x = 1
+        >>> local.x
+        1
+        >>> task = Task()
+        >>> hasattr(local, 'x')
+        False
+    """
+    class local(object):
+        def __init__(self):
+            object.__setattr__(self, '_dicts', weakref.WeakKeyDictionary())
+
+        def _getdict(self):
+            key = current()
+            try:
+                return self._dicts[key]
+            except KeyError:
+                d = self._dicts[key] = {}
+                return d
+
+        def __getattr__(self, key):
+            try:
+                return self._getdict()[key]
+            except KeyError:
+                raise AttributeError, key
+
+        def __setattr__(self, key, value):
+            self._getdict()[key] = value
+
+        def __delattr__(self, key):
+            try:
+                del self._getdict()[key]
+            except KeyError:
+                raise AttributeError, key
+
+    return local
 
 threadeddict = ThreadedDict
 
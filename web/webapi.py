@@ -6,7 +6,7 @@ Web API (wrapper around WSGI)
 __all__ = [
     "config",
     "header", "debug",
-    "input", "data",
+    "input", "data", "data_stream", "iterparts",
     "setcookie", "cookies",
     "ctx", 
     "HTTPError", 
@@ -19,24 +19,100 @@ __all__ = [
     "Redirect", "Found", "SeeOther", "NotModified", "TempRedirect", 
     "redirect", "found", "seeother", "notmodified", "tempredirect",
 
-    # 400, 401, 403, 404, 405, 406, 409, 410, 412
-    "BadRequest", "Unauthorized", "Forbidden", "NotFound", "NoMethod", "NotAcceptable", "Conflict", "Gone", "PreconditionFailed",
-    "badrequest", "unauthorized", "forbidden", "notfound", "nomethod", "notacceptable", "conflict", "gone", "preconditionfailed",
+    # 400, 401, 403, 404, 405, 406, 409, 410, 412, 413
+    "BadRequest", "Unauthorized", "Forbidden", "NotFound", "NoMethod", "NotAcceptable", "Conflict", "Gone", "PreconditionFailed", "RequestEntityTooLarge",
+    "badrequest", "unauthorized", "forbidden", "notfound", "nomethod", "notacceptable", "conflict", "gone", "preconditionfailed", "requestentitytoolarge",
 
     # 500
     "InternalError", 
     "internalerror",
 ]
 
-import sys, cgi, Cookie, pprint, urlparse, urllib
-from utils import storage, storify, threadeddict, dictadd, intget, utf8
+import sys, os, cgi, Cookie, pprint, urlparse, urllib, tempfile
+from utils import storage, storify, threadeddict, dictadd, intget, utf8, lstrips, safeunicode
 
-config = storage()
+class _Config(storage):
+    """
+    Storage which calls the functions watching a key when the key is set 
+    or deleted.
+    
+        >>> c = _Config()
+        >>> def f(): print 'changed'
+        ...
+        >>> c.watch('a', f)
+        >>> c.a = 1
+        changed
+        >>> c.setdefault('a', 2)
+        1
+        >>> del c['a']
+        changed
+    """
+    def __init__(self, *a, **kw):
+        self.__dict__['_watchers'] = {}
+        storage.__init__(self, *a, **kw)
+    
+    def watch(self, key, f):
+        """Calls `f()` whenever `key` is set or deleted."""
+        self._watchers.setdefault(key, []).append(f)
+    
+    def _changed(self, key):
+        for f in self._watchers.get(key, []):
+            f()
+    
+    def __setitem__(self, key, value):
+        storage.__setitem__(self, key, value)
+        self._changed(key)
+    
+    def __delitem__(self, key):
+        storage.__delitem__(self, key)
+        self._changed(key)
+    
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+    
+    def update(self, *a, **kw):
+        for key, value in dict(*a, **kw).items():
+            self[key] = value
+    
+    def pop(self, key, *default):
+        if key not in self:
+            return storage.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+    
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+config = _Config()
 config.__doc__ = """
 A configuration object for various aspects of web.py.
 
 `debug`
    : when True, enables reloading, disabled template caching and sets internalerror to debugerror.
+
+`max_body_size`
+   : maximum size in bytes of request bodies. Reading a larger body raises `413 Request Entity Too Large`.
+
+`upload_memory_threshold` (default: 524288)
+   : size in bytes up to which uploaded files are kept in memory, larger ones are written to temporary files.
+
+`static_cache_size`
+   : size in bytes of the in-memory cache for small files under `static/`, used by 
+     the builtin server. The cache is disabled by default.
+
+`processor_timing`
+   : when True, applications collect per-processor timings (see `application.processor_timings`).
+
+`content_length`
+   : when True, responses whose whole body is known get a `Content-Length` header.
+
+`etag`
+   : when True, successful GET responses whose whole body is known get an `ETag` header 
+     computed from the body, and requests with a matching `If-None-Match` get `304 Not Modified`.
 """
 
 class HTTPError(Exception):
@@ -154,6 +230,7 @@ forbidden = Forbidden = _status_code("403 Forbidden")
 notacceptable = NotAcceptable = _status_code("406 Not Acceptable")
 conflict = Conflict = _status_code("409 Conflict")
 preconditionfailed = PreconditionFailed = _status_code("412 Precondition Failed")
+requestentitytoolarge = RequestEntityTooLarge = _status_code("413 Request Entity Too Large")
 
 class NoMethod(HTTPError):
     """A `405 Method Not Allowed` error."""
@@ -215,57 +292,386 @@ def header(hdr, value, unique=False):
     if '\n' in hdr or '\r' in hdr or '\n' in value or '\r' in value:
         raise ValueError, 'invalid characters in header'
         
-    if unique is True:
-        for h, v in ctx.headers:
-            if h.lower() == hdr.lower(): return
+    if unique is True and _has_header(hdr):
+        return
     
     ctx.headers.append((hdr, value))
+
+def _has_header(hdr):
+    """Returns True if the response header `hdr` is already set."""
+    headers = ctx.headers
+    if isinstance(headers, _Headers):
+        return headers.has(hdr)
+    hdr = hdr.lower()
+    for h, v in headers:
+        if h.lower() == hdr: return True
+    return False
+
+class _Headers(list):
+    """
+    A list of `(name, value)` response headers that also keeps an index of 
+    the header names, so that checking whether a header is set doesn't 
+    need to go through the whole list.
     
+        >>> h = _Headers([('Content-Type', 'text/html')])
+        >>> h.append(('X-Foo', 'bar'))
+        >>> h.has('content-type'), h.has('x-foo'), h.has('x-bar')
+        (True, True, False)
+        >>> del h[0]
+        >>> h.has('content-type')
+        False
+        >>> h
+        [('X-Foo', 'bar')]
+    """
+    def __init__(self, headers=()):
+        list.__init__(self, headers)
+        self._names = None
+
+    def has(self, name):
+        """Returns True if a header called `name` (case-insensitive) is set."""
+        if self._names is None:
+            self._names = set(h.lower() for h, v in self)
+        return name.lower() in self._names
+
+    def append(self, header):
+        list.append(self, header)
+        if self._names is not None:
+            self._names.add(header[0].lower())
+
+    # any other change to the list invalidates the index
+    def _invalidate(method):
+        def f(self, *a, **kw):
+            self._names = None
+            return method(self, *a, **kw)
+        f.__name__ = method.__name__
+        return f
+
+    for _m in ['__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__', 
+               'extend', 'insert', 'pop', 'remove']:
+        locals()[_m] = _invalidate(getattr(list, _m))
+    del _m, _invalidate
+    
+class _Part:
+    """A part of a multipart request body.
+    
+    `name`, `filename` and `type` come from its headers, which are in `headers`
+    with lowercase names. The data is read with `read` or by iterating over 
+    the part, which yields it in chunks.
+    """
+    bufsize = 64 * 1024
+
+    def __init__(self, headers, readchunk):
+        self.headers = headers
+        disposition, options = cgi.parse_header(headers.get('content-disposition', ''))
+        self.name = options.get('name')
+        self.filename = options.get('filename')
+        self.type = cgi.parse_header(headers.get('content-type', 'text/plain'))[0]
+        self._readchunk = readchunk
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(self)
+        out = []
+        while size > 0:
+            data = self._readchunk(size)
+            if not data:
+                break
+            out.append(data)
+            size -= len(data)
+        return ''.join(out)
+
+    def __iter__(self):
+        while True:
+            data = self._readchunk(self.bufsize)
+            if not data:
+                break
+            yield data
+
+    def __repr__(self):
+        return '<Part %r %r>' % (self.name, self.filename)
+
+class _MultipartReader:
+    """
+    Incremental parser of multipart bodies. Iterating over it reads parts 
+    from `fp` as they are needed. Data of a part that isn't read is skipped.
+    
+    `length` is the size of the body. When it is unknown, `fp` is read by
+    lines so that nothing after the closing boundary is consumed.
+    
+        >>> from StringIO import StringIO
+        >>> body = '--b\\r\\nContent-Disposition: form-data; name="x"\\r\\n\\r\\nfoo\\r\\n--b--\\r\\n'
+        >>> [(p.name, p.read()) for p in _MultipartReader(StringIO(body), 'b')]
+        [('x', 'foo')]
+    """
+    bufsize = 64 * 1024
+    max_header_size = 64 * 1024
+
+    def __init__(self, fp, boundary, length=None, max_size=None):
+        self.fp = fp
+        self.length = length
+        self.max_size = max_size
+        self.bytes_read = 0
+        self.delim = '\n--' + boundary
+        # the first boundary doesn't follow a line break.
+        self.buf = '\r\n'
+        self.eof = False
+        self.done = False
+        # the preamble is read and dropped like the data of a part.
+        self.in_part = True
+
+    def _fill(self):
+        """Reads more of the body into the buffer. Returns False at the end of it."""
+        if self.eof:
+            return False
+        if self.length is None:
+            data = _read_body(self.fp.readline, self.bufsize)
+        elif self.length > 0:
+            data = _read_body(self.fp.read, min(self.bufsize, self.length))
+            self.length -= len(data)
+        else:
+            data = ''
+        if not data:
+            self.eof = True
+            return False
+        self.bytes_read += len(data)
+        if self.max_size and self.bytes_read > self.max_size:
+            raise requestentitytoolarge()
+        self.buf += data
+        return True
+
+    def _readchunk(self, size):
+        """Returns at most `size` bytes of data of the current part, or '' at its end."""
+        while self.in_part:
+            i = self.buf.find(self.delim)
+            if i >= 0:
+                end = i
+                if i and self.buf[i-1] == '\r':
+                    end = i - 1
+            else:
+                # keep what may be the beginning of the delimiter.
+                end = len(self.buf) - len(self.delim)
+
+            if end > 0:
+                end = min(end, size)
+                data, self.buf = self.buf[:end], self.buf[end:]
+                return data
+            elif i >= 0:
+                self.buf = self.buf[i + len(self.delim):]
+                self.in_part = False
+            elif not self._fill():
+                # body ended without a closing boundary.
+                data, self.buf = self.buf, ''
+                self.in_part = False
+                self.done = True
+                return data
+        return ''
+
+    def _readline(self):
+        """Returns the next line in the buffer without consuming it, or None at the end of the body."""
+        while True:
+            nl = self.buf.find('\n')
+            if nl >= 0:
+                return self.buf[:nl+1]
+            if len(self.buf) > self.max_header_size:
+                raise badrequest()
+            if not self._fill():
+                return None
+
+    def _next_part(self):
+        """Reads up to the data of the next part and returns its headers,
+        or None after the closing boundary.
+        """
+        while len(self.buf) < 2 and self._fill():
+            pass
+        if self.buf[:2] == '--':
+            self.done = True
+            return None
+
+        # rest of the boundary line
+        line = self._readline()
+        if line is None:
+            self.done = True
+            return None
+        self.buf = self.buf[len(line):]
+
+        headers = []
+        while True:
+            line = self._readline()
+            if line is None:
+                break
+            value = line.rstrip('\r\n')
+            if not value:
+                self.buf = self.buf[len(line):]
+                break
+            elif value[0] in ' \t' and headers:
+                # continuation line
+                k, v = headers[-1]
+                headers[-1] = (k, v + ' ' + value.strip())
+            elif ':' in value:
+                k, v = value.split(':', 1)
+                headers.append((k.strip().lower(), v.strip()))
+            else:
+                # not a header, so the data starts here.
+                break
+            self.buf = self.buf[len(line):]
+
+        self.in_part = True
+        return dict(headers)
+
+    def __iter__(self):
+        while self._readchunk(self.bufsize):
+            pass
+        while not self.done:
+            headers = self._next_part()
+            if headers is None:
+                break
+            yield _Part(headers, self._readchunk)
+            while self._readchunk(self.bufsize):
+                pass
+
+class _FileUpload(cgi.FieldStorage):
+    """An uploaded file. Works like the FieldStorage of a file upload,
+    with the data in `file`, a temporary file kept in memory while small.
+    """
+    def __init__(self, part, file):
+        self.fp = None
+        self.headers = part.headers
+        self.name = part.name
+        self.filename = part.filename
+        self.disposition, self.disposition_options = cgi.parse_header(part.headers.get('content-disposition', ''))
+        self.type, self.type_options = cgi.parse_header(part.headers.get('content-type', 'text/plain'))
+        self.file = file
+        self.list = None
+        self.length = -1
+        self.innerboundary = ''
+        self.outerboundary = ''
+        self.done = 1
+
+def _multipart_boundary():
+    ctype, options = cgi.parse_header(ctx.env.get('CONTENT_TYPE', ''))
+    boundary = options.get('boundary', '')
+    if not ctype.lower().startswith('multipart/') or not cgi.valid_boundary(boundary):
+        raise badrequest()
+    return boundary
+
+def _multipart_reader():
+    boundary = _multipart_boundary()
+    if 'data' in ctx:
+        # the body has already been read by web.data()
+        from cStringIO import StringIO
+        return _MultipartReader(StringIO(ctx.data), boundary, len(ctx.data))
+    length = intget(ctx.env.get('CONTENT_LENGTH'), None)
+    if length is not None:
+        _check_body_size(length)
+    return _MultipartReader(ctx.env['wsgi.input'], boundary, length, config.get('max_body_size'))
+
+def _query_pairs():
+    """Returns the query string parsed as a list of (name, value) pairs."""
+    if '_query_pairs' not in ctx:
+        ctx._query_pairs = urlparse.parse_qsl(ctx.env.get('QUERY_STRING', ''), keep_blank_values=1)
+    return ctx._query_pairs
+
+def _body_pairs():
+    """Returns the request body parsed as a list of (name, value) pairs.
+    
+    Like cgi.FieldStorage, query arguments are included for POST requests.
+    """
+    if '_body_pairs' in ctx:
+        return ctx._body_pairs
+
+    e = ctx.env
+    method = e['REQUEST_METHOD']
+    if 'CONTENT_TYPE' in e:
+        ctype = cgi.parse_header(e['CONTENT_TYPE'])[0].lower()
+    elif method == 'POST':
+        ctype = 'application/x-www-form-urlencoded'
+    else:
+        ctype = 'text/plain'
+    query = (method == 'POST' and _query_pairs()) or []
+
+    if ctype.startswith('multipart/'):
+        threshold = config.get('upload_memory_threshold', 512 * 1024)
+        parts = []
+        for part in _multipart_reader():
+            if part.name is None:
+                continue
+            elif part.filename is None:
+                parts.append((part.name, part.read()))
+            else:
+                f = tempfile.SpooledTemporaryFile(max_size=threshold)
+                for chunk in part:
+                    f.write(chunk)
+                f.seek(0)
+                parts.append((part.name, _FileUpload(part, f)))
+        ctx._multipart = parts
+        pairs = query + parts
+    elif ctype == 'application/x-www-form-urlencoded':
+        pairs = urlparse.parse_qsl(data(), keep_blank_values=1) + query
+    else:
+        pairs = []
+
+    ctx._body_pairs = pairs
+    return pairs
+
+def iterparts():
+    """
+    Iterates over the parts of a multipart request body while they are read
+    from the client. Each part has `name`, `filename`, `type` and `headers` 
+    attributes and its data is read with `read(size)` or by iterating over it.
+    The data of a part must be read before moving to the next one.
+
+    Parts streamed this way are not kept, so `web.input` won't include them.
+    If the body has already been parsed by `web.input`, its parts are 
+    iterated from there.
+    """
+    if '_multipart' in ctx:
+        for name, value in ctx._multipart:
+            if isinstance(value, _FileUpload):
+                value.file.seek(0)
+                yield _Part(value.headers, value.file.read)
+            else:
+                from cStringIO import StringIO
+                headers = {'content-disposition': 'form-data; name="%s"' % name}
+                yield _Part(headers, StringIO(value).read)
+        return
+
+    reader = _multipart_reader()
+    ctx._multipart = []
+    ctx._body_pairs = (ctx.env['REQUEST_METHOD'] == 'POST' and list(_query_pairs())) or []
+    for part in reader:
+        yield part
+
 def rawinput(method=None):
     """Returns storage object with GET or POST arguments.
+    
+    The query string and the request body are parsed only once per request.
+    Uploaded files are kept in temporary files, in memory while smaller than
+    `web.config.upload_memory_threshold` bytes.
     """
     method = method or "both"
-    from cStringIO import StringIO
 
-    def dictify(fs): 
-        # hack to make web.input work with enctype='text/plain.
-        if fs.list is None:
-            fs.list = [] 
-
-        return dict([(k, fs[k]) for k in fs.keys()])
+    def dictify(pairs): 
+        d = {}
+        for k, v in pairs:
+            if k in d:
+                if isinstance(d[k], list):
+                    d[k].append(v)
+                else:
+                    d[k] = [d[k], v]
+            else:
+                d[k] = v
+        return d
     
-    e = ctx.env.copy()
     a = b = {}
     
     if method.lower() in ['both', 'post', 'put']:
-        if e['REQUEST_METHOD'] in ['POST', 'PUT']:
-            if e.get('CONTENT_TYPE', '').lower().startswith('multipart/'):
-                # since wsgi.input is directly passed to cgi.FieldStorage, 
-                # it can not be called multiple times. Saving the FieldStorage
-                # object in ctx to allow calling web.input multiple times.
-                a = ctx.get('_fieldstorage')
-                if not a:
-                    fp = e['wsgi.input']
-                    a = cgi.FieldStorage(fp=fp, environ=e, keep_blank_values=1)
-                    ctx._fieldstorage = a
-            else:
-                fp = StringIO(data())
-                a = cgi.FieldStorage(fp=fp, environ=e, keep_blank_values=1)
-            a = dictify(a)
+        if ctx.env['REQUEST_METHOD'] in ['POST', 'PUT']:
+            a = dictify(_body_pairs())
 
     if method.lower() in ['both', 'get']:
-        e['REQUEST_METHOD'] = 'GET'
-        b = dictify(cgi.FieldStorage(environ=e, keep_blank_values=1))
-
-    def process_fieldstorage(fs):
-        if isinstance(fs, list):
-            return [process_fieldstorage(x) for x in fs]
-        elif fs.filename is None:
-            return fs.value
-        else:
-            return fs
+        b = dictify(_query_pairs())
 
-    return storage([(k, process_fieldstorage(v)) for k, v in dictadd(b, a).items()])
+    return storage(dictadd(b, a))
 
 def input(*requireds, **defaults):
     """
@@ -280,42 +686,126 @@ def input(*requireds, **defaults):
     except KeyError:
         raise badrequest()
 
+def _check_body_size(length):
+    limit = config.get('max_body_size')
+    if limit and length > limit:
+        raise requestentitytoolarge()
+
+def _read_body(read, size):
+    """Calls `read(size)` on the request body. The builtin server raises 
+    MaxSizeExceeded when a chunked body grows past its `max_request_body_size`,
+    which is turned into `requestentitytoolarge`.
+    """
+    try:
+        return read(size)
+    except Exception, e:
+        from wsgiserver import MaxSizeExceeded
+        if isinstance(e, MaxSizeExceeded):
+            raise requestentitytoolarge()
+        raise
+
+def data_stream(chunk_size=64 * 1024):
+    """
+    Iterates over the data sent with the request in chunks of `chunk_size` 
+    bytes, reading it from the client as it goes. Data that has been read 
+    this way is not returned by `data()` anymore.
+    
+    Raises `requestentitytoolarge` before reading anything if the body is 
+    larger than `web.config.max_body_size`. When the server streams a body 
+    of unknown length (`wsgi.input_terminated`, e.g. a chunked upload), 
+    it is read until EOF and the limit is checked as the data comes in.
+    """
+    if 'data' in ctx:
+        data = ctx.data
+        for i in xrange(0, len(data), chunk_size):
+            yield data[i:i+chunk_size]
+        return
+
+    if '_data_left' not in ctx:
+        if 'CONTENT_LENGTH' not in ctx.env and ctx.env.get('wsgi.input_terminated'):
+            ctx._data_left = None
+            ctx._data_read = 0
+        else:
+            cl = intget(ctx.env.get('CONTENT_LENGTH'), 0)
+            _check_body_size(cl)
+            ctx._data_left = cl
+
+    fp = ctx.env['wsgi.input']
+    while ctx._data_left is None:
+        chunk = _read_body(fp.read, chunk_size)
+        if not chunk:
+            ctx._data_left = 0
+            break
+        ctx._data_read += len(chunk)
+        _check_body_size(ctx._data_read)
+        yield chunk
+
+    while ctx._data_left > 0:
+        chunk = _read_body(fp.read, min(chunk_size, ctx._data_left))
+        if not chunk:
+            ctx._data_left = 0
+            break
+        ctx._data_left -= len(chunk)
+        yield chunk
+
 def data():
     """Returns the data sent with the request."""
     if 'data' not in ctx:
-        cl = intget(ctx.env.get('CONTENT_LENGTH'), 0)
-        ctx.data = ctx.env['wsgi.input'].read(cl)
+        ctx.data = ''.join(data_stream())
     return ctx.data
 
 def setcookie(name, value, expires="", domain=None, secure=False, httponly=False):
     """Sets a cookie."""
     if expires < 0: 
         expires = -1000000000 
-    kargs = {'expires': expires, 'path':'/'}
-    if domain: 
-        kargs['domain'] = domain
-    if secure:
-        kargs['secure'] = secure
+    if name.lower() in Cookie.Morsel._reserved or name.translate(Cookie._idmap, Cookie._LegalChars):
+        raise Cookie.CookieError("Illegal key value: %s" % name)
+
     # @@ should we limit cookies to a different path?
-    cookie = Cookie.SimpleCookie()
-    cookie[name] = urllib.quote(utf8(value))
-    for key, val in kargs.iteritems(): 
-        cookie[name][key] = val
+    # formatted the way Cookie.Morsel.OutputString does, without creating a SimpleCookie.
+    out = [name + '=' + Cookie._quote(urllib.quote(utf8(value)))]
+    if domain:
+        out.append('Domain=%s' % domain)
+    if expires != "":
+        if type(expires) == type(1):
+            out.append('expires=' + Cookie._getdate(expires))
+        else:
+            out.append('expires=%s' % expires)
+    out.append('Path=/')
+    if secure:
+        out.append('secure')
 
-    value = cookie.items()[0][1].OutputString()
+    value = '; '.join(out)
     if httponly:
         value += '; httponly'
     header('Set-Cookie', value)
 
+def _parse_cookies(http_cookie):
+    """
+    Parses the value of the `Cookie` header into a dict. Attributes like 
+    `$Path` and keys that aren't valid cookie names are skipped.
+    
+        >>> _parse_cookies('a=1; b="x y"; $Path=/; c=%20')
+        {'a': '1', 'c': '%20', 'b': 'x y'}
+    """
+    cookies = {}
+    for m in Cookie._CookiePattern.finditer(http_cookie):
+        key, value = m.group('key'), m.group('val')
+        if value is None or key[0] == '$' or key.lower() in Cookie.Morsel._reserved or key.translate(Cookie._idmap, Cookie._LegalChars):
+            continue
+        cookies[key] = Cookie._unquote(value)
+    return cookies
+
 def cookies(*requireds, **defaults):
     """
     Returns a `storage` object with all the cookies in it.
     See `storify` for how `requireds` and `defaults` work.
     """
-    cookie = Cookie.SimpleCookie()
-    cookie.load(ctx.env.get('HTTP_COOKIE', ''))
+    # the Cookie header is parsed only once per request.
+    if '_cookies' not in ctx:
+        ctx._cookies = _parse_cookies(ctx.env.get('HTTP_COOKIE', ''))
     try:
-        d = storify(cookie, *requireds, **defaults)
+        d = storify(ctx._cookies, *requireds, **defaults)
         for k, v in d.items():
             d[k] = v and urllib.unquote(v)
         return d
@@ -343,7 +833,117 @@ def _debugwrite(x):
     out.write(x)
 debug.write = _debugwrite
 
-ctx = context = threadeddict()
+def _protocol(env):
+    if env.get('wsgi.url_scheme') in ['http', 'https']:
+        return env['wsgi.url_scheme']
+    elif env.get('HTTPS', '').lower() in ['on', 'true', '1']:
+        return 'https'
+    else:
+        return 'http'
+
+def _homedomain(env):
+    return _protocol(env) + '://' + env.get('HTTP_HOST', '[unknown]')
+
+def _homepath(env):
+    return os.environ.get('REAL_SCRIPT_NAME', env.get('SCRIPT_NAME', ''))
+
+def _home(env):
+    return _homedomain(env) + _homepath(env)
+
+def _path(env):
+    # http://trac.lighttpd.net/trac/ticket/406 requires:
+    if env.get('SERVER_SOFTWARE', '').startswith('lighttpd/'):
+        path = lstrips(env.get('REQUEST_URI').split('?')[0], _homepath(env))
+        # Apache and CherryPy webservers unquote the url but lighttpd doesn't. 
+        # unquote explicitly for lighttpd to make ctx.path uniform across all servers.
+        return urllib.unquote(path)
+    return env.get('PATH_INFO')
+
+def _query(env):
+    if env.get('QUERY_STRING'):
+        return '?' + env.get('QUERY_STRING', '')
+    else:
+        return ''
+
+class _Context(storage):
+    """Storage for `ctx` that computes the request fields derived from
+    `environ` when they are first accessed. Computed values are stored
+    like any other value, so they can be overwritten.
+    """
+    derived = {
+        'protocol': _protocol,
+        'homedomain': _homedomain,
+        'homepath': _homepath,
+        'home': _home,
+        #@@ home is changed when the request is handled to a sub-application.
+        #@@ but the real home is required for doing absolute redirects.
+        'realhome': _home,
+        'host': lambda env: env.get('HTTP_HOST'),
+        'ip': lambda env: env.get('REMOTE_ADDR'),
+        'method': lambda env: env.get('REQUEST_METHOD'),
+        'path': _path,
+        'query': _query,
+        'fullpath': lambda env: _path(env) + _query(env),
+    }
+
+    def __missing__(self, key):
+        if key not in self.derived or not dict.__contains__(self, 'environ'):
+            raise KeyError, key
+        value = self.derived[key](dict.__getitem__(self, 'environ'))
+        if isinstance(value, str):
+            value = safeunicode(value)
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key in self.derived and dict.__contains__(self, 'environ'))
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _compute_all(self):
+        if dict.__contains__(self, 'environ'):
+            for key in self.derived:
+                self[key]
+
+    def keys(self):
+        self._compute_all()
+        return dict.keys(self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def items(self):
+        self._compute_all()
+        return dict.items(self)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        self._compute_all()
+        return dict.values(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def copy(self):
+        self._compute_all()
+        return _Context(self)
+
+    def __repr__(self):
+        self._compute_all()
+        return storage.__repr__(self)
+
+ctx = context = threadeddict(_Context)
 
 ctx.__doc__ = """
 A `storage` object containing various information about the request:
@@ -7,7 +7,7 @@ import os, sys
 
 import http
 import webapi as web
-from utils import listget
+from utils import listget, intget
 from net import validaddr, validip
 import httpserver
     
@@ -25,6 +25,9 @@ def runwsgi(func):
     """
     Runs a WSGI-compatible `func` using FCGI, SCGI, or a simple web server,
     as appropriate based on context and `sys.argv`.
+    
+    With `prefork` (or `prefork=N`) on the command line, the simple web 
+    server runs in several (`N`) processes, see `httpserver.runprefork`.
     """
     
     if os.environ.has_key('SERVER_SOFTWARE'): # cgi
@@ -51,6 +54,12 @@ def runwsgi(func):
         else:
             return runscgi(func)
     
+    prefork = [a for a in sys.argv[1:] if a == 'prefork' or a.startswith('prefork=')]
+    if prefork:
+        args = [a for a in sys.argv[1:] if a not in prefork]
+        workers = intget(prefork[0].split('=', 1)[-1], None)
+        return httpserver.runprefork(func, validip(listget(args, 0, '')), workers)
+    
     return httpserver.runsimple(func, validip(listget(sys.argv, 1, '')))
     
 def _is_dev_mode():
@@ -58,7 +67,8 @@ def _is_dev_mode():
     if os.environ.has_key('SERVER_SOFTWARE') \
         or os.environ.has_key('PHP_FCGI_CHILDREN') \
         or 'fcgi' in sys.argv or 'fastcgi' in sys.argv \
-        or 'mod_wsgi' in sys.argv:
+        or 'mod_wsgi' in sys.argv \
+        or [a for a in sys.argv if a.startswith('prefork')]:
             return False
     return True
 
@@ -25,6 +25,11 @@ Want SSL support? Just set these attributes:
     
     server.ssl_certificate = <filename>
     server.ssl_private_key = <filename>
+
+For local testing, a self-signed certificate will do:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 365 \\
+        -subj /CN=localhost -keyout key.pem -out cert.pem
     
     if __name__ == '__main__':
         try:
@@ -60,9 +65,10 @@ number of requests and their responses, so we run a nested loop:
         ->  while True:
                 req = HTTPRequest(...)
                 req.parse_request()
-                ->  # Read the Request-Line, e.g. "GET /page HTTP/1.1"
-                    req.rfile.readline()
-                    req.read_headers()
+                ->  # Read the Request-Line, e.g. "GET /page HTTP/1.1",
+                    # and the headers, up to the first empty line.
+                    head = req.rfile.readuntil(head_delims)
+                    req.parse_headers(head.split("\r\n")[1:])
                 req.respond()
                 ->  response = wsgi_app(...)
                     try:
@@ -83,13 +89,15 @@ import Queue
 import re
 quoted_slash = re.compile("(?i)%2F")
 import rfc822
+import select
 import socket
-try:
-    import cStringIO as StringIO
-except ImportError:
-    import StringIO
 
 _fileobject_uses_str_type = isinstance(socket._fileobject(None)._rbuf, basestring)
+try:
+    _memoryview = memoryview
+except NameError:
+    # Python 2.6 has bytearray, but no memoryview.
+    _memoryview = None
 
 import sys
 import threading
@@ -105,6 +113,23 @@ try:
 except ImportError:
     SSL = None
 
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile, for Python 2
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    import ssl
+    if not hasattr(ssl, "SSLContext"):
+        # Python < 2.7.9
+        ssl = None
+except ImportError:
+    ssl = None
+
 import errno
 
 def plat_specific_errors(*errnames):
@@ -183,6 +208,28 @@ class WSGIPathInfoDispatcher(object):
 class MaxSizeExceeded(Exception):
     pass
 
+
+# The request head ends at the first empty line. A bare LF one isn't legal
+# HTTP, but is looked for too so that it can be answered with a 400 at once.
+head_delims = ("\r\n\r\n", "\n\n")
+
+def _find_delim(data, delims, start=0, end=None):
+    """Return (index, length) of the first of delims in data[start:end].
+    
+    delims may be a single string or a tuple of strings; index is -1 if
+    none of them is found.
+    """
+    if end is None:
+        end = len(data)
+    if isinstance(delims, str):
+        return data.find(delims, start, end), len(delims)
+    found = -1, 0
+    for delim in delims:
+        i = data.find(delim, start, end)
+        if i >= 0 and (found[0] < 0 or i < found[0]):
+            found = i, len(delim)
+    return found
+
 class SizeCheckWrapper(object):
     """Wraps a file-like object, raising MaxSizeExceeded if too large."""
     
@@ -220,6 +267,20 @@ class SizeCheckWrapper(object):
             if len(data) < 256 or data[-1:] == "\n":
                 return ''.join(res)
     
+    def readuntil(self, delim):
+        """Read up to and including delim (or until EOF).
+        
+        delim may also be a tuple of strings, to stop at the first of them.
+        """
+        limit = 0
+        if self.maxlen:
+            # Stop reading as soon as we're past maxlen.
+            limit = self.maxlen - self.bytes_read + 1
+        data = self.rfile.readuntil(delim, limit)
+        self.bytes_read += len(data)
+        self._check_length()
+        return data
+    
     def readlines(self, sizehint=0):
         # Shamelessly stolen from StringIO
         total = 0
@@ -246,6 +307,182 @@ class SizeCheckWrapper(object):
         return data
 
 
+class ChunkedRFile(object):
+    """Wraps a file-like object, decoding the 'chunked' transfer-coding.
+    
+    The body is decoded as it is read, rather than buffered up front.
+    maxlen (if non-zero) is the largest allowed size of the decoded body;
+    MaxSizeExceeded is raised as soon as a chunk would pass it. Once the
+    last chunk has been read, the trailer lines (without CRLF) are passed
+    to on_trailers, if given.
+    """
+    
+    def __init__(self, rfile, maxlen, on_trailers=None):
+        self.rfile = rfile
+        self.maxlen = maxlen
+        self.on_trailers = on_trailers
+        self.bytes_read = 0
+        self.buffer = ""
+        self.closed = False
+    
+    def _next_chunk(self):
+        """Decode and return the next chunk, or "" after the last one."""
+        if self.closed:
+            return ""
+        
+        line = self.rfile.readline()
+        if not line:
+            raise ValueError("Illegal end of chunked transfer-coding.")
+        chunk_size = line.strip().split(";", 1)[0]
+        try:
+            chunk_size = int(chunk_size, 16)
+        except ValueError:
+            raise ValueError("Bad chunked transfer size: %r" % chunk_size)
+        
+        if chunk_size <= 0:
+            self.closed = True
+            self._read_trailers()
+            return ""
+        
+        if self.maxlen and self.bytes_read + chunk_size > self.maxlen:
+            raise MaxSizeExceeded()
+        
+        chunk = self.rfile.read(chunk_size)
+        self.bytes_read += len(chunk)
+        crlf = self.rfile.read(2)
+        if crlf != "\r\n":
+            raise ValueError("Bad chunked transfer coding "
+                             "(expected '\\r\\n', got %r)" % crlf)
+        return chunk
+    
+    def _read_trailers(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                # No more data--illegal end of headers
+                raise ValueError("Illegal end of headers.")
+            
+            if line == '\r\n':
+                # Normal end of headers
+                break
+            lines.append(line.rstrip("\r\n"))
+        
+        if self.on_trailers is not None:
+            self.on_trailers(lines)
+    
+    def read(self, size=None):
+        if size is None or size < 0:
+            data = [self.buffer]
+            self.buffer = ""
+            while True:
+                chunk = self._next_chunk()
+                if not chunk:
+                    return "".join(data)
+                data.append(chunk)
+        
+        data = self.buffer
+        while len(data) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            data += chunk
+        self.buffer = data[size:]
+        return data[:size]
+    
+    def readline(self, size=None):
+        if size is not None and size < 0:
+            size = None
+        data = self.buffer
+        start = 0
+        while True:
+            nl = data.find("\n", start, size)
+            if nl >= 0:
+                self.buffer = data[nl + 1:]
+                return data[:nl + 1]
+            if size is not None and len(data) >= size:
+                self.buffer = data[size:]
+                return data[:size]
+            
+            start = len(data)
+            chunk = self._next_chunk()
+            if not chunk:
+                self.buffer = ""
+                return data
+            data += chunk
+    
+    def readlines(self, sizehint=0):
+        # Shamelessly stolen from StringIO
+        total = 0
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+            line = self.readline()
+        return lines
+    
+    def close(self):
+        # The connection's rfile is not ours to close.
+        pass
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.readline()
+        if not data:
+            raise StopIteration
+        return data
+
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper of this server.
+    
+    Iterating over it reads the file in blocks of blksize bytes. But when
+    an application returns one, and the file has a fileno(), the server
+    sends the rest of the file with sendfile() instead (if available, and
+    if the connection isn't encrypted): the data then never goes through
+    Python at all.
+    """
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+# WSGI environ keys for common request headers, so that their names don't
+# need to be uppercased and concatenated for every request.
+header_envnames = {}
+for _h in ["Accept", "Accept-Charset", "Accept-Encoding", "Accept-Language",
+           "Authorization", "Cache-Control", "Connection", "Content-Length",
+           "Content-Type", "Cookie", "Expect", "Host", "If-Match",
+           "If-Modified-Since", "If-None-Match", "If-Range",
+           "If-Unmodified-Since", "Keep-Alive", "Origin", "Pragma", "Range",
+           "Referer", "TE", "Transfer-Encoding", "Upgrade", "User-Agent",
+           "Via", "X-Forwarded-For", "X-Forwarded-Host", "X-Forwarded-Proto",
+           "X-Real-IP", "X-Requested-With"]:
+    _e = "HTTP_" + _h.upper().replace("-", "_")
+    header_envnames[_h] = header_envnames[_h.lower()] = header_envnames[_h.upper()] = _e
+del _h, _e
+
+comma_separated_envnames = dict.fromkeys(["HTTP_" + h.replace("-", "_")
+                                          for h in comma_separated_headers])
+
+
 class HTTPRequest(object):
     """An HTTP Request (and response).
     
@@ -279,10 +516,17 @@ class HTTPRequest(object):
     chunked_write: if True, output will be encoded with the "chunked"
         transfer-coding. This value is set automatically inside
         send_headers.
+    write_buffer_size: if non-zero, output is held back until at least
+        this many bytes are pending (or the response is complete), so that
+        many tiny chunks go out in few writes. Note this delays streamed
+        output, which PEP 333 asks servers not to do; the default is 0.
+        The status line and headers are always held back until the first
+        chunk of the body (if any), and sent together with it.
     """
     
     max_request_header_size = 0
     max_request_body_size = 0
+    write_buffer_size = 0
     
     def __init__(self, wfile, environ, wsgi_app):
         self.rfile = environ['wsgi.input']
@@ -297,6 +541,10 @@ class HTTPRequest(object):
         self.sent_headers = False
         self.close_connection = False
         self.chunked_write = False
+        self.outbuf = []
+        self.outbuf_size = 0
+        # Until the Request-Line has been parsed.
+        self.response_protocol = "HTTP/1.0"
     
     def parse_request(self):
         """Parse the next HTTP request start-line and message-headers."""
@@ -317,21 +565,28 @@ class HTTPRequest(object):
         # and doesn't need the client to request or acknowledge the close
         # (although your TCP stack might suffer for it: cf Apache's history
         # with FIN_WAIT_2).
-        request_line = self.rfile.readline()
-        if not request_line:
-            # Force self.ready = False so the connection will close.
-            self.ready = False
-            return
+        # The Request-Line and the headers are read in one go.
+        head = self.rfile.readuntil(head_delims)
         
-        if request_line == "\r\n":
+        if head[:2] == "\r\n":
             # RFC 2616 sec 4.1: "...if the server is reading the protocol
             # stream at the beginning of a message and receives a CRLF
             # first, it should ignore the CRLF."
             # But only ignore one leading line! else we enable a DoS.
-            request_line = self.rfile.readline()
-            if not request_line:
-                self.ready = False
-                return
+            head = head[2:]
+        
+        if not head:
+            # Force self.ready = False so the connection will close.
+            self.ready = False
+            return
+        
+        lines = head.split("\r\n")
+        if head.count("\n") != len(lines) - 1:
+            # A line ended with a bare LF.
+            self.simple_response("400 Bad Request",
+                                 "HTTP requires CRLF terminators")
+            return
+        request_line = lines[0]
         
         environ = self.environ
         
@@ -400,7 +655,10 @@ class HTTPRequest(object):
         
         # then all the http headers
         try:
-            self.read_headers()
+            if not head.endswith("\r\n\r\n"):
+                # No more data--illegal end of headers
+                raise ValueError("Illegal end of headers.")
+            self.parse_headers(lines[1:])
         except ValueError, ex:
             self.simple_response("400 Bad Request", repr(ex.args))
             return
@@ -462,29 +720,32 @@ class HTTPRequest(object):
         
         self.ready = True
     
-    def read_headers(self):
-        """Read header lines from the incoming stream."""
+    def parse_headers(self, lines):
+        """Set environ entries for the given header lines (without CRLF).
+        
+        Stops at the first empty line.
+        """
         environ = self.environ
+        envname = None
         
-        while True:
-            line = self.rfile.readline()
+        for line in lines:
             if not line:
-                # No more data--illegal end of headers
-                raise ValueError("Illegal end of headers.")
-            
-            if line == '\r\n':
-                # Normal end of headers
                 break
             
             if line[0] in ' \t':
                 # It's a continuation line.
-                v = line.strip()
-            else:
-                k, v = line.split(":", 1)
-                k, v = k.strip().upper(), v.strip()
-                envname = "HTTP_" + k.replace("-", "_")
+                if envname is None:
+                    raise ValueError("Illegal continuation line.")
+                environ[envname] = environ[envname] + " " + line.strip()
+                continue
+            
+            k, v = line.split(":", 1)
+            envname = header_envnames.get(k)
+            if envname is None:
+                envname = "HTTP_" + k.strip().upper().replace("-", "_")
+            v = v.strip()
             
-            if k in comma_separated_headers:
+            if envname in comma_separated_envnames:
                 existing = environ.get(envname)
                 if existing:
                     v = ", ".join((existing, v))
@@ -497,33 +758,6 @@ class HTTPRequest(object):
         if cl is not None:
             environ["CONTENT_LENGTH"] = cl
     
-    def decode_chunked(self):
-        """Decode the 'chunked' transfer coding."""
-        cl = 0
-        data = StringIO.StringIO()
-        while True:
-            line = self.rfile.readline().strip().split(";", 1)
-            chunk_size = int(line.pop(0), 16)
-            if chunk_size <= 0:
-                break
-##            if line: chunk_extension = line[0]
-            cl += chunk_size
-            data.write(self.rfile.read(chunk_size))
-            crlf = self.rfile.read(2)
-            if crlf != "\r\n":
-                self.simple_response("400 Bad Request",
-                                     "Bad chunked transfer coding "
-                                     "(expected '\\r\\n', got %r)" % crlf)
-                return
-        
-        # Grab any trailer headers
-        self.read_headers()
-        
-        data.seek(0)
-        self.environ["wsgi.input"] = data
-        self.environ["CONTENT_LENGTH"] = str(cl) or ""
-        return True
-    
     def respond(self):
         """Call the appropriate WSGI app and write its iterable output."""
         # Set rfile.maxlen to ensure we don't read past Content-Length.
@@ -549,21 +783,40 @@ class HTTPRequest(object):
     
     def _respond(self):
         if self.chunked_read:
-            if not self.decode_chunked():
-                self.close_connection = True
-                return
+            # The body is decoded as the application reads it; its length
+            # is unknown until then, so wsgi.input is read until EOF.
+            body = ChunkedRFile(self.rfile, self.max_request_body_size,
+                                self.parse_headers)
+            self.environ["wsgi.input"] = body
+            self.environ["wsgi.input_terminated"] = True
+            self.environ.pop("CONTENT_LENGTH", None)
         
         response = self.wsgi_app(self.environ, self.start_response)
         try:
-            for chunk in response:
-                # "The start_response callable must not actually transmit
-                # the response headers. Instead, it must store them for the
-                # server or gateway to transmit only after the first
-                # iteration of the application return value that yields
-                # a NON-EMPTY string, or upon the application's first
-                # invocation of the write() callable." (PEP 333)
-                if chunk:
-                    self.write(chunk)
+            if (isinstance(response, FileWrapper) and self.started_response
+                and not self.sent_headers and self.send_file(response.filelike)):
+                # Sent with sendfile().
+                pass
+            else:
+                if (self.started_response and not self.sent_headers
+                    and isinstance(response, (list, tuple)) and len(response) == 1):
+                    # The whole body is known, so send a Content-Length
+                    # instead of using the chunked transfer-coding.
+                    status = int(self.status[:3])
+                    hkeys = [key.lower() for key, value in self.outheaders]
+                    if ("content-length" not in hkeys and status >= 200
+                        and status not in (204, 205, 304)):
+                        self.outheaders.append(("Content-Length", str(len(response[0]))))
+                
+                for chunk in response:
+                    # "The start_response callable must not actually transmit
+                    # the response headers. Instead, it must store them for the
+                    # server or gateway to transmit only after the first
+                    # iteration of the application return value that yields
+                    # a NON-EMPTY string, or upon the application's first
+                    # invocation of the write() callable." (PEP 333)
+                    if chunk:
+                        self.write(chunk)
         finally:
             if hasattr(response, "close"):
                 response.close()
@@ -572,7 +825,79 @@ class HTTPRequest(object):
             self.sent_headers = True
             self.send_headers()
         if self.chunked_write:
-            self.wfile.sendall("0\r\n\r\n")
+            self.outbuf.append("0\r\n\r\n")
+        self.flush()
+        
+        if self.chunked_read and not self.close_connection:
+            # Discard whatever the application didn't read of the body,
+            # so that the next request on this connection can be parsed.
+            try:
+                while body.read(8192):
+                    pass
+            except (ValueError, MaxSizeExceeded):
+                self.close_connection = True
+    
+    def send_file(self, filelike):
+        """Send the rest of the given file as the body, with sendfile().
+        
+        The Content-Length header (if any) says how much of the file to
+        send; if missing it is set to the rest of the file. Returns False,
+        without sending anything, if sendfile() can't be used (it isn't
+        available, the connection is encrypted, or the file has no file
+        descriptor).
+        """
+        if sendfile is None or self.wfile.encrypted:
+            return False
+        try:
+            fd = filelike.fileno()
+            offset = filelike.tell()
+            size = os.fstat(fd).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        
+        count = None
+        for k, v in self.outheaders:
+            if k.lower() == "content-length":
+                count = int(v)
+                break
+        
+        status = int(self.status[:3])
+        if status < 200 or status in (204, 205, 304):
+            count = 0
+        elif count is None:
+            count = max(size - offset, 0)
+            self.outheaders.append(("Content-Length", str(count)))
+        if self.environ["REQUEST_METHOD"] == "HEAD":
+            count = 0
+        
+        self.sent_headers = True
+        self.send_headers()
+        self.flush()
+        
+        sock = self.wfile._sock
+        out = sock.fileno()
+        timeout = sock.gettimeout()
+        while count > 0:
+            try:
+                sent = sendfile(out, fd, offset, count)
+            except OSError, e:
+                if e.args[0] in socket_errors_nonblocking:
+                    # The socket has a timeout, so it's non-blocking.
+                    r, w, x = select.select([], [out], [], timeout)
+                    if not w:
+                        raise socket.timeout("timed out")
+                    continue
+                if e.args[0] in socket_error_eintr:
+                    continue
+                raise socket.error(*e.args)
+            if not sent:
+                # The file is shorter than we said. The client won't
+                # know where the next response starts.
+                self.close_connection = True
+                break
+            offset += sent
+            count -= sent
+        return True
     
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
@@ -631,11 +956,39 @@ class HTTPRequest(object):
             self.sent_headers = True
             self.send_headers()
         
+        outbuf = self.outbuf
         if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], "\r\n", chunk, "\r\n"]
-            self.wfile.sendall("".join(buf))
+            outbuf.append("%x\r\n" % len(chunk))
+            outbuf.append(chunk)
+            outbuf.append("\r\n")
         else:
-            self.wfile.sendall(chunk)
+            outbuf.append(chunk)
+        self.outbuf_size += len(chunk)
+        if self.outbuf_size >= self.write_buffer_size:
+            self.flush()
+    
+    def flush(self):
+        """Send any output held back by write or send_headers."""
+        outbuf = self.outbuf
+        if not outbuf:
+            return
+        self.outbuf = []
+        self.outbuf_size = 0
+        
+        # Small pieces are joined so they go out in as few syscalls as
+        # possible. Large ones are sent as they are: copying them would
+        # cost more than the extra syscall.
+        small = []
+        for data in outbuf:
+            if len(data) < 65536:
+                small.append(data)
+                continue
+            if small:
+                self.wfile.sendall("".join(small))
+                small = []
+            self.wfile.sendall(data)
+        if small:
+            self.wfile.sendall("".join(small))
     
     def send_headers(self):
         """Assert, process, and send the HTTP response message-headers."""
@@ -705,7 +1058,8 @@ class HTTPRequest(object):
             else:
                 raise
         buf.append("\r\n")
-        self.wfile.sendall("".join(buf))
+        # Held back until the first chunk of the body is written (see flush).
+        self.outbuf.append("".join(buf))
 
 
 class NoSSLError(Exception):
@@ -720,7 +1074,32 @@ class FatalSSLAlert(Exception):
 
 if not _fileobject_uses_str_type:
     class CP_fileobject(socket._fileobject):
-        """Faux file object attached to a socket object."""
+        """Faux file object attached to a socket object.
+        
+        Incoming data is kept in a bytearray which is reused for the whole
+        life of the connection: the socket reads into it with recv_into,
+        and lines are searched for in place. Only the bytes handed back to
+        the caller are copied.
+        """
+        
+        # Whether socket data can be received straight into the buffer.
+        use_recv_into = True
+        
+        # Whether the data on the socket is encrypted (SSL/TLS).
+        encrypted = False
+        
+        def __init__(self, sock, mode='rb', bufsize=-1, close=False):
+            socket._fileobject.__init__(self, sock, mode, bufsize, close)
+            self._alloc(max(self._rbufsize, self.default_bufsize))
+        
+        def _alloc(self, size):
+            self._rbuf = bytearray(size)
+            if self.use_recv_into and _memoryview is not None:
+                self._rview = _memoryview(self._rbuf)
+            else:
+                self._rview = None
+            # Unconsumed data is self._rbuf[self._rpos:self._rend].
+            self._rpos = self._rend = 0
 
         def sendall(self, data):
             """Sendall for non-blocking sockets."""
@@ -750,155 +1129,169 @@ if not _fileobject_uses_str_type:
                         and e.args[0] not in socket_error_eintr):
                         raise
 
+        def recv_into(self, buf, size):
+            while True:
+                try:
+                    return self._sock.recv_into(buf, size)
+                except socket.error, e:
+                    if (e.args[0] not in socket_errors_nonblocking
+                        and e.args[0] not in socket_error_eintr):
+                        raise
+
+        def _reserve(self, size):
+            """Make room for size more bytes at the end of the read buffer."""
+            pos, end = self._rpos, self._rend
+            n = end - pos
+            if n + size > len(self._rbuf):
+                old = self._rbuf
+                self._alloc(max(n + size, 2 * len(old)))
+                self._rbuf[:n] = old[pos:end]
+            elif pos:
+                # Move the unconsumed bytes to the front.
+                self._rbuf[:n] = self._rbuf[pos:end]
+                self._rpos = 0
+            self._rend = n
+
+        def _fill(self, size):
+            """Receive up to size bytes into the read buffer.
+            
+            Returns the number of bytes received (0 on EOF).
+            """
+            if self._rend + size > len(self._rbuf):
+                self._reserve(size)
+            end = self._rend
+            if self._rview is not None:
+                n = self.recv_into(self._rview[end:end + size], size)
+            else:
+                data = self.recv(size)
+                n = len(data)
+                if end + n > len(self._rbuf):
+                    self._reserve(n)
+                    end = self._rend
+                self._rbuf[end:end + n] = data
+            self._rend = end + n
+            return n
+
+        def _take(self, size):
+            """Consume and return size bytes from the read buffer."""
+            pos = self._rpos
+            if self._rview is not None:
+                data = self._rview[pos:pos + size].tobytes()
+            else:
+                data = str(self._rbuf[pos:pos + size])
+            pos += size
+            if pos == self._rend:
+                if len(self._rbuf) > 8 * self.default_bufsize:
+                    # Don't hold on to the memory of a huge read.
+                    self._alloc(max(self._rbufsize, self.default_bufsize))
+                    return data
+                pos = self._rend = 0
+            self._rpos = pos
+            return data
+
+        def buffered(self):
+            """Return the number of bytes read from the socket but not consumed."""
+            return self._rend - self._rpos
+
+        def unread(self, data):
+            """Put data back in front of the read buffer."""
+            n = len(data)
+            if n <= self._rpos:
+                self._rpos -= n
+                self._rbuf[self._rpos:self._rpos + n] = data
+            else:
+                data += self._take(self._rend - self._rpos)
+                self._reserve(len(data))
+                self._rbuf[:len(data)] = data
+                self._rend = len(data)
+
+        def readuntil(self, delim, limit=0):
+            """Read up to and including delim (or until EOF).
+            
+            delim may also be a tuple of strings, to stop at the first of
+            them. Raises MaxSizeExceeded if more than limit bytes (when
+            given) are buffered without finding delim.
+            """
+            if isinstance(delim, str):
+                longest = len(delim)
+            else:
+                longest = max([len(d) for d in delim])
+            if self._rbufsize <= 1:
+                # Unbuffered: don't read past delim.
+                recv_size = 1
+            else:
+                recv_size = self._rbufsize
+            scanned = 0
+            while True:
+                pos = self._rpos
+                i, n = _find_delim(self._rbuf, delim, pos + scanned, self._rend)
+                if i >= 0:
+                    return self._take(i + n - pos)
+                have = self._rend - pos
+                if limit and have > limit:
+                    raise MaxSizeExceeded()
+                scanned = max(0, have - longest + 1)
+                if not self._fill(recv_size):
+                    return self._take(have)
+
         def read(self, size=-1):
-            # Use max, disallow tiny reads in a loop as they are very inefficient.
-            # We never leave read() with any leftover data from a new recv() call
-            # in our internal buffer.
-            rbufsize = max(self._rbufsize, self.default_bufsize)
-            # Our use of StringIO rather than lists of string objects returned by
-            # recv() minimizes memory usage and fragmentation that occurs when
-            # rbufsize is large compared to the typical return value of recv().
-            buf = self._rbuf
-            buf.seek(0, 2)  # seek end
             if size < 0:
                 # Read until EOF
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    data = self.recv(rbufsize)
-                    if not data:
-                        break
-                    buf.write(data)
-                return buf.getvalue()
-            else:
-                # Read until size bytes or EOF seen, whichever comes first
-                buf_len = buf.tell()
-                if buf_len >= size:
-                    # Already have size bytes in our buffer?  Extract and return.
-                    buf.seek(0)
-                    rv = buf.read(size)
-                    self._rbuf = StringIO.StringIO()
-                    self._rbuf.write(buf.read())
-                    return rv
-
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    left = size - buf_len
-                    # recv() will malloc the amount of memory given as its
-                    # parameter even though it often returns much less data
-                    # than that.  The returned data string is short lived
-                    # as we copy it into a StringIO and free it.  This avoids
-                    # fragmentation issues on many platforms.
-                    data = self.recv(left)
-                    if not data:
-                        break
-                    n = len(data)
-                    if n == size and not buf_len:
-                        # Shortcut.  Avoid buffer data copies when:
-                        # - We have no data in our buffer.
-                        # AND
-                        # - Our call to recv returned exactly the
-                        #   number of bytes we were asked to read.
-                        return data
-                    if n == left:
-                        buf.write(data)
-                        del data  # explicit free
-                        break
-                    assert n <= left, "recv(%d) returned %d bytes" % (left, n)
-                    buf.write(data)
-                    buf_len += n
-                    del data  # explicit free
-                    #assert buf_len == buf.tell()
-                return buf.getvalue()
+                recv_size = max(self._rbufsize, self.default_bufsize)
+                while self._fill(recv_size):
+                    pass
+                return self._take(self._rend - self._rpos)
+            
+            # Read until size bytes or EOF seen, whichever comes first.
+            # We never leave read() with any leftover data from a new recv()
+            # call in our internal buffer.
+            have = self._rend - self._rpos
+            if have >= size:
+                return self._take(size)
+            if not have and size >= len(self._rbuf):
+                # Shortcut. A large read into an empty buffer: avoid the
+                # copy through the buffer if recv returns everything.
+                data = self.recv(size)
+                if len(data) == size or not data:
+                    return data
+                self.unread(data)
+                have = len(data)
+            while have < size:
+                n = self._fill(size - have)
+                if not n:
+                    break
+                have += n
+            # recv may return more than was asked for (see SSL_fileobject);
+            # leave the rest in the buffer.
+            return self._take(min(have, size))
 
         def readline(self, size=-1):
-            buf = self._rbuf
-            buf.seek(0, 2)  # seek end
-            if buf.tell() > 0:
-                # check if we already have it in our buffer
-                buf.seek(0)
-                bline = buf.readline(size)
-                if bline.endswith('\n') or len(bline) == size:
-                    self._rbuf = StringIO.StringIO()
-                    self._rbuf.write(buf.read())
-                    return bline
-                del bline
-            if size < 0:
-                # Read until \n or EOF, whichever comes first
-                if self._rbufsize <= 1:
-                    # Speed up unbuffered case
-                    buf.seek(0)
-                    buffers = [buf.read()]
-                    self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                    data = None
-                    recv = self.recv
-                    while data != "\n":
-                        data = recv(1)
-                        if not data:
-                            break
-                        buffers.append(data)
-                    return "".join(buffers)
-
-                buf.seek(0, 2)  # seek end
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    data = self.recv(self._rbufsize)
-                    if not data:
-                        break
-                    nl = data.find('\n')
-                    if nl >= 0:
-                        nl += 1
-                        buf.write(data[:nl])
-                        self._rbuf.write(data[nl:])
-                        del data
-                        break
-                    buf.write(data)
-                return buf.getvalue()
+            if self._rbufsize <= 1:
+                # Unbuffered: don't read past the newline.
+                recv_size = 1
             else:
-                # Read until size bytes or \n or EOF seen, whichever comes first
-                buf.seek(0, 2)  # seek end
-                buf_len = buf.tell()
-                if buf_len >= size:
-                    buf.seek(0)
-                    rv = buf.read(size)
-                    self._rbuf = StringIO.StringIO()
-                    self._rbuf.write(buf.read())
-                    return rv
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    data = self.recv(self._rbufsize)
-                    if not data:
-                        break
-                    left = size - buf_len
-                    # did we just receive a newline?
-                    nl = data.find('\n', 0, left)
-                    if nl >= 0:
-                        nl += 1
-                        # save the excess data to _rbuf
-                        self._rbuf.write(data[nl:])
-                        if buf_len:
-                            buf.write(data[:nl])
-                            break
-                        else:
-                            # Shortcut.  Avoid data copy through buf when returning
-                            # a substring of our first recv().
-                            return data[:nl]
-                    n = len(data)
-                    if n == size and not buf_len:
-                        # Shortcut.  Avoid data copy through buf when
-                        # returning exactly all of our first recv().
-                        return data
-                    if n >= left:
-                        buf.write(data[:left])
-                        self._rbuf.write(data[left:])
-                        break
-                    buf.write(data)
-                    buf_len += n
-                    #assert buf_len == buf.tell()
-                return buf.getvalue()
+                recv_size = self._rbufsize
+            scanned = 0
+            while True:
+                pos, end = self._rpos, self._rend
+                if size >= 0:
+                    end = min(end, pos + size)
+                nl = self._rbuf.find('\n', pos + scanned, end)
+                if nl >= 0:
+                    return self._take(nl + 1 - pos)
+                have = self._rend - pos
+                if size >= 0 and have >= size:
+                    return self._take(size)
+                scanned = have
+                if not self._fill(recv_size):
+                    return self._take(have)
 
 else:
     class CP_fileobject(socket._fileobject):
         """Faux file object attached to a socket object."""
+        
+        # Whether the data on the socket is encrypted (SSL/TLS).
+        encrypted = False
 
         def sendall(self, data):
             """Sendall for non-blocking sockets."""
@@ -928,6 +1321,43 @@ else:
                         and e.args[0] not in socket_error_eintr):
                         raise
 
+        def buffered(self):
+            """Return the number of bytes read from the socket but not consumed."""
+            return len(self._rbuf)
+
+        def unread(self, data):
+            """Put data back in front of the read buffer."""
+            self._rbuf = data + self._rbuf
+
+        def readuntil(self, delim, limit=0):
+            """Read up to and including delim (or until EOF).
+            
+            delim may also be a tuple of strings, to stop at the first of
+            them. Raises MaxSizeExceeded if more than limit bytes (when
+            given) are buffered without finding delim.
+            """
+            if isinstance(delim, str):
+                longest = len(delim)
+            else:
+                longest = max([len(d) for d in delim])
+            data = self._rbuf
+            self._rbuf = ""
+            bufsize = max(self._rbufsize, self.default_bufsize)
+            start = 0
+            while True:
+                i, n = _find_delim(data, delim, start)
+                if i >= 0:
+                    i += n
+                    self._rbuf = data[i:]
+                    return data[:i]
+                if limit and len(data) > limit:
+                    raise MaxSizeExceeded()
+                start = max(0, len(data) - longest + 1)
+                chunk = self.recv(bufsize)
+                if not chunk:
+                    return data
+                data += chunk
+
         def read(self, size=-1):
             if size < 0:
                 # Read until EOF
@@ -1047,6 +1477,11 @@ class SSL_fileobject(CP_fileobject):
     ssl_timeout = 3
     ssl_retry = .01
     
+    # recv() also drains the connection's pending bytes, and so
+    # may return more than was asked for.
+    use_recv_into = False
+    encrypted = True
+    
     def _safe_call(self, is_reader, call, *args, **kwargs):
         """Wrap the given call with SSL error-trapping.
         
@@ -1103,6 +1538,9 @@ class SSL_fileobject(CP_fileobject):
             if not p:
                 return "".join(buf)
     
+    def buffered(self):
+        return CP_fileobject.buffered(self) + self._sock.pending()
+    
     def sendall(self, *args, **kwargs):
         return self._safe_call(False, super(SSL_fileobject, self).sendall, *args, **kwargs)
 
@@ -1110,6 +1548,35 @@ class SSL_fileobject(CP_fileobject):
         return self._safe_call(False, super(SSL_fileobject, self).send, *args, **kwargs)
 
 
+class BuiltinSSL_fileobject(CP_fileobject):
+    """File object attached to an ssl.SSLSocket (the builtin ssl module)."""
+    
+    encrypted = True
+    
+    def _safe_call(self, call, *args):
+        """Call the given SSLSocket method, translating ssl.SSLError."""
+        try:
+            return call(*args)
+        except ssl.SSLError, e:
+            if getattr(e, "reason", None) == "HTTP_REQUEST":
+                # The client is talking HTTP to an HTTPS server.
+                raise NoSSLError()
+            raise FatalSSLAlert(*e.args)
+    
+    def recv(self, size):
+        return self._safe_call(self._sock.recv, size)
+    
+    def recv_into(self, buf, size):
+        return self._safe_call(self._sock.recv_into, buf, size)
+    
+    def send(self, data):
+        return self._safe_call(self._sock.send, data)
+    
+    def buffered(self):
+        # Include data decrypted by OpenSSL but not read yet.
+        return CP_fileobject.buffered(self) + self._sock.pending()
+
+
 class HTTPConnection(object):
     """An HTTP connection (active socket).
     
@@ -1123,12 +1590,28 @@ class HTTPConnection(object):
     
     rbufsize = -1
     RequestHandlerClass = HTTPRequest
+    
+    # The ConnectionPoller that parks this connection between requests,
+    # if any. See communicate() and poll_read().
+    poller = None
+    last_active = None
+    _head = ""
+    
+    # When this connection was put on the ThreadPool queue, and how long
+    # it waited there for a worker thread (in seconds).
+    queued_at = None
+    queue_wait = 0.0
+    
+    # False until the TLS handshake of an ssl.SSLSocket is done (see
+    # handshake).
+    handshake_done = True
     environ = {"wsgi.version": (1, 0),
                "wsgi.url_scheme": "http",
                "wsgi.multithread": True,
                "wsgi.multiprocess": False,
                "wsgi.run_once": False,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
                }
     
     def __init__(self, sock, wsgi_app, environ):
@@ -1145,6 +1628,10 @@ class HTTPConnection(object):
             self.rfile.ssl_timeout = timeout
             self.wfile = SSL_fileobject(sock, "wb", -1)
             self.wfile.ssl_timeout = timeout
+        elif ssl is not None and isinstance(sock, ssl.SSLSocket):
+            self.rfile = BuiltinSSL_fileobject(sock, "rb", self.rbufsize)
+            self.wfile = BuiltinSSL_fileobject(sock, "wb", -1)
+            self.handshake_done = False
         else:
             self.rfile = CP_fileobject(sock, "rb", self.rbufsize)
             self.wfile = CP_fileobject(sock, "wb", -1)
@@ -1156,13 +1643,26 @@ class HTTPConnection(object):
         self.environ["wsgi.input"] = SizeCheckWrapper(self.rfile, 0)
     
     def communicate(self):
-        """Read each request and respond appropriately."""
+        """Read each request and respond appropriately.
+        
+        Returns True if the connection is idle but should be kept open,
+        in which case the caller hands it back to self.poller. This is only
+        done when there is a poller, otherwise the connection is kept
+        until the client closes it or the socket times out.
+        """
+        req = None
         try:
+            if not self.handshake_done:
+                self.handshake()
+            
             while True:
                 # (re)set req to None so that if something goes wrong in
                 # the RequestHandlerClass constructor, the error doesn't
                 # get written to the previous request.
                 req = None
+                # Only the first request after a wait in the queue waited.
+                self.environ["wsgiserver.queue_wait"] = self.queue_wait
+                self.queue_wait = 0.0
                 req = self.RequestHandlerClass(self.wfile, self.environ,
                                                self.wsgi_app)
                 
@@ -1174,10 +1674,14 @@ class HTTPConnection(object):
                 req.respond()
                 if req.close_connection:
                     return
+                
+                if self.poller is not None and not self.rfile.buffered():
+                    # Wait for the next request without holding a thread.
+                    return True
         
         except socket.error, e:
             errnum = e.args[0]
-            if errnum == 'timed out':
+            if errnum == 'timed out' or isinstance(e, socket.timeout):
                 if req and not req.sent_headers:
                     req.simple_response("408 Request Timeout")
             elif errnum not in socket_errors_to_ignore:
@@ -1191,7 +1695,11 @@ class HTTPConnection(object):
             # Close the connection.
             return
         except NoSSLError:
-            if req and not req.sent_headers:
+            if req is None:
+                # Raised by the handshake, before any request.
+                req = self.RequestHandlerClass(self.wfile, self.environ,
+                                               self.wsgi_app)
+            if not req.sent_headers:
                 # Unwrap our wfile
                 req.wfile = CP_fileobject(self.socket._sock, "wb", -1)
                 req.simple_response("400 Bad Request",
@@ -1204,8 +1712,60 @@ class HTTPConnection(object):
     
     linger = False
     
-    def close(self):
+    def handshake(self):
+        """Do the TLS handshake of a connection wrapped with the ssl module.
+        
+        The server wraps accepted sockets without doing the handshake, so
+        that it is done here, by a worker thread, instead of holding up the
+        thread that calls accept().
+        """
+        self.rfile._safe_call(self.socket.do_handshake)
+        self.handshake_done = True
+        self.environ["SSL_PROTOCOL"] = self.socket.version()
+        self.environ["SSL_CIPHER"] = self.socket.cipher()[0]
+    
+    def poll_read(self):
+        """Read whatever is available on the (readable) socket.
+        
+        Called by the poller, which must not block. Returns True once a
+        complete Request-Line and message-headers are buffered (or the
+        header size limit is reached), so that a worker can parse them
+        without waiting on the client. Returns False if more data is
+        needed, and None if the client closed the connection.
+        """
+        if self.rfile.encrypted:
+            # Encrypted data can't be inspected here; let a worker read it.
+            return True
+        
+        try:
+            data = self.socket.recv(8192)
+        except socket.error, e:
+            if e.args[0] in socket_errors_nonblocking or e.args[0] in socket_error_eintr:
+                return False
+            return None
+        if not data:
+            return None
+        
+        head = self._head + data
+        limit = self.RequestHandlerClass.max_request_header_size or 65536
+        if len(head) >= limit or _find_delim(head, head_delims)[0] >= 0:
+            self._head = ""
+            self.rfile.unread(head)
+            return True
+        self._head = head
+        return False
+    
+    def close(self):
         """Close the socket underlying this connection."""
+        if isinstance(self.rfile, BuiltinSSL_fileobject) and self.handshake_done:
+            # Send close_notify, without waiting for the client's: OpenSSL
+            # drops sessions which weren't shut down from its cache.
+            try:
+                self.socket.settimeout(0)
+                self.socket.unwrap()
+            except (socket.error, ValueError):
+                pass
+        
         self.rfile.close()
         
         if not self.linger:
@@ -1267,11 +1827,17 @@ class WorkerThread(threading.Thread):
                     return
                 
                 self.conn = conn
+                if conn.queued_at is not None:
+                    conn.queue_wait = time.time() - conn.queued_at
+                keep = False
                 try:
-                    conn.communicate()
+                    keep = conn.communicate()
                 finally:
-                    conn.close()
                     self.conn = None
+                    if keep:
+                        conn.poller.put(conn)
+                    else:
+                        conn.close()
         except (KeyboardInterrupt, SystemExit), exc:
             self.server.interrupt = exc
 
@@ -1279,76 +1845,222 @@ class WorkerThread(threading.Thread):
 class ThreadPool(object):
     """A Request Queue for the CherryPyWSGIServer which pools threads.
     
-    ThreadPool objects must provide min, get(), put(obj), start()
-    and stop(timeout) attributes.
+    ThreadPool objects must provide min, get(), put(obj), put_nowait(obj),
+    full(), start() and stop(timeout) attributes.
+    
+    If max is greater than min, the pool scales itself: it grows (up to max
+    threads) as soon as connections are queued with no idle thread to take
+    them, and it stops threads which stayed idle during a whole idle_timeout
+    period (down to min). Growing reacts at once while shrinking waits for
+    a full quiet period, so a pool doesn't flap under bursty load.
+    
+    accepted_queue_size: the maximum number of connections waiting for a
+        worker thread (defaults to -1 = no limit). When the queue is full,
+        put() waits for up to accepted_queue_timeout seconds and then
+        raises Queue.Full; put_nowait() raises it at once.
+    
+    idle: the number of worker threads which are not handling a connection.
+    size: the number of worker threads.
+    peak: the highest number of worker threads the pool has had.
     """
     
-    def __init__(self, server, min=10, max=-1):
+    idle_timeout = 30
+    
+    def __init__(self, server, min=10, max=-1, idle_timeout=None,
+                 accepted_queue_size=-1, accepted_queue_timeout=10):
         self.server = server
         self.min = min
         self.max = max
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.accepted_queue_timeout = accepted_queue_timeout
         self._threads = []
-        self._queue = Queue.Queue()
-        self.get = self._queue.get
+        self._queue = Queue.Queue(accepted_queue_size)
+        self._lock = threading.Lock()
+        self._idle = 0
+        self._idle_low = 0
+        # Connections put on the queue which no worker has taken yet.
+        self._waiting = 0
+        self._stopping = 0
+        self.peak = 0
+        self._controller = None
     
     def start(self):
         """Start the pool of threads."""
-        for i in xrange(self.min):
-            self._threads.append(WorkerThread(self.server))
-        for worker in self._threads:
-            worker.setName("CP WSGIServer " + worker.getName())
-            worker.start()
-        for worker in self._threads:
+        self._lock.acquire()
+        try:
+            self._spawn(self.min)
+        finally:
+            self._lock.release()
+        for worker in self._threads[:]:
             while not worker.ready:
                 time.sleep(.1)
+        
+        if self.max > self.min:
+            self._controller = threading.Thread(target=self._control)
+            self._controller.setName("CP WSGIServer " + self._controller.getName() + " (pool controller)")
+            self._controller.setDaemon(True)
+            self._controller.start()
     
     def _get_idle(self):
         """Number of worker threads which are idle. Read-only."""
-        return len([t for t in self._threads if t.conn is None])
+        return self._idle
     idle = property(_get_idle, doc=_get_idle.__doc__)
     
-    def put(self, obj):
-        self._queue.put(obj)
+    def _get_size(self):
+        """Number of worker threads. Read-only."""
+        return len(self._threads)
+    size = property(_get_size, doc=_get_size.__doc__)
+    
+    def get(self):
+        """Return the next connection, waiting for one (called by workers)."""
+        worker = threading.currentThread()
+        self._lock.acquire()
+        try:
+            if getattr(worker, "starting", False):
+                # New threads are counted as idle by grow().
+                worker.starting = False
+            else:
+                self._idle += 1
+        finally:
+            self._lock.release()
+        
+        obj = self._queue.get()
+        
+        self._lock.acquire()
+        try:
+            self._idle -= 1
+            if self._idle < self._idle_low:
+                self._idle_low = self._idle
+            if obj is not _SHUTDOWNREQUEST:
+                self._waiting -= 1
+            else:
+                if self._stopping > 0:
+                    self._stopping -= 1
+                if worker in self._threads:
+                    self._threads.remove(worker)
+        finally:
+            self._lock.release()
+        return obj
+    
+    def full(self):
+        """Return True if no more connections can be queued right now."""
+        return self._queue.full()
+    
+    def put(self, obj, block=True):
         if obj is _SHUTDOWNREQUEST:
+            self._queue.put(obj)
             return
+        
+        obj.queued_at = time.time()
+        self._add_waiting(1)
+        try:
+            self._queue.put(obj, block, self.accepted_queue_timeout)
+        except Queue.Full:
+            self._add_waiting(-1)
+            raise
+        
+        # Both counts change together in get(), so a worker which just
+        # took a connection off the queue is not taken for an idle one.
+        self._lock.acquire()
+        try:
+            backlog = self._waiting - self._idle
+        finally:
+            self._lock.release()
+        if self._controller is not None and backlog > 0:
+            # Not enough idle threads to take what is queued: grow now.
+            self.grow(backlog)
+    
+    def put_nowait(self, obj):
+        """Put obj on the queue, or raise Queue.Full at once if it's full."""
+        self.put(obj, False)
+    
+    def _add_waiting(self, n):
+        self._lock.acquire()
+        try:
+            self._waiting += n
+        finally:
+            self._lock.release()
     
     def grow(self, amount):
         """Spawn new worker threads (not above self.max)."""
+        self._lock.acquire()
+        try:
+            if self.max > 0:
+                amount = min(amount, self.max - (len(self._threads) - self._stopping))
+            self._spawn(amount)
+        finally:
+            self._lock.release()
+    
+    def _spawn(self, amount):
         for i in xrange(amount):
-            if self.max > 0 and len(self._threads) >= self.max:
-                break
             worker = WorkerThread(self.server)
             worker.setName("CP WSGIServer " + worker.getName())
+            worker.starting = True
+            self._idle += 1
             self._threads.append(worker)
             worker.start()
+        if len(self._threads) > self.peak:
+            self.peak = len(self._threads)
     
     def shrink(self, amount):
         """Kill off worker threads (not below self.min)."""
-        # Grow/shrink the pool if necessary.
-        # Remove any dead threads from our list
-        for t in self._threads:
-            if not t.isAlive():
-                self._threads.remove(t)
-                amount -= 1
-        
-        if amount > 0:
-            for i in xrange(min(amount, len(self._threads) - self.min)):
-                # Put a number of shutdown requests on the queue equal
-                # to 'amount'. Once each of those is processed by a worker,
-                # that worker will terminate and be culled from our list
-                # in self.put.
-                self._queue.put(_SHUTDOWNREQUEST)
+        self._lock.acquire()
+        try:
+            # Remove any dead threads from our list
+            self._threads = [t for t in self._threads if t.isAlive()]
+            amount = max(min(amount, len(self._threads) - self._stopping - self.min), 0)
+            self._stopping += amount
+        finally:
+            self._lock.release()
+        
+        # Put a number of shutdown requests on the queue equal
+        # to 'amount'. Once each of those is processed by a worker,
+        # that worker will terminate and be culled from our list
+        # in self.get. This is done without holding the lock, which
+        # the workers need in self.get to make room in a full queue.
+        for i in xrange(amount):
+            self._queue.put(_SHUTDOWNREQUEST)
+    
+    def _control(self):
+        """Shrink the pool by the threads that were never needed during
+        the last idle_timeout seconds (run in its own thread).
+        """
+        window_start = time.time()
+        self._idle_low = self._idle
+        while self._controller is not None:
+            time.sleep(1)
+            now = time.time()
+            if now - window_start < self.idle_timeout:
+                continue
+            
+            self._lock.acquire()
+            try:
+                unused = self._idle_low
+                self._idle_low = self._idle
+            finally:
+                self._lock.release()
+            window_start = now
+            if unused > 0:
+                self.shrink(unused)
     
     def stop(self, timeout=5):
+        self._controller = None
+        
         # Must shut down threads here so the code that calls
         # this method can know when all threads are stopped.
-        for worker in self._threads:
+        self._lock.acquire()
+        try:
+            threads = self._threads[:]
+        finally:
+            self._lock.release()
+        for worker in threads:
             self._queue.put(_SHUTDOWNREQUEST)
         
         # Don't join currentThread (when stop is called inside a request).
         current = threading.currentThread()
-        while self._threads:
-            worker = self._threads.pop()
+        while threads:
+            worker = threads.pop()
             if worker is not current and worker.isAlive():
                 try:
                     if timeout is None or timeout < 0:
@@ -1371,7 +2083,206 @@ class ThreadPool(object):
                         # See http://www.cherrypy.org/ticket/691.
                         KeyboardInterrupt), exc1:
                     pass
+        self._threads = []
+
+
+class _Poll(object):
+    """A minimal wrapper around select.epoll or select.poll (readability only)."""
+    
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poll = select.epoll()
+            self._mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._scale = 1
+        else:
+            self._poll = select.poll()
+            self._mask = select.POLLIN | select.POLLERR | select.POLLHUP
+            self._scale = 1000
+    
+    def register(self, fd):
+        self._poll.register(fd, self._mask)
+    
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+    
+    def poll(self, timeout):
+        return self._poll.poll(timeout * self._scale)
+    
+    def close(self):
+        if hasattr(self._poll, "close"):
+            self._poll.close()
+
+poll_available = hasattr(select, "epoll") or hasattr(select, "poll")
+
 
+class ConnectionPoller(object):
+    """Parks connections until they have a request ready for a worker.
+    
+    New connections and idle keep-alive connections are put() here instead
+    of on the server's ThreadPool. A single thread waits for them to become
+    readable (with epoll or poll) and buffers what they send without
+    blocking. Once a connection has a complete request head buffered, it is
+    handed to the ThreadPool; after the response, the worker puts it back
+    here. So idle and slow clients don't tie up worker threads.
+    
+    server: the HTTP Server which owns the ThreadPool.
+    timeout: connections idle for longer than this (in seconds) are closed.
+    """
+    
+    def __init__(self, server, timeout=10):
+        self.server = server
+        self.timeout = timeout
+        self.ready = False
+        self._conns = {}
+        self._pending = []
+        # Connections with a request, waiting for room in the server's
+        # queue (with the "pause" overload_policy).
+        self._ready_conns = []
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def _get_parked(self):
+        """Number of connections waiting in the poller. Read-only."""
+        return len(self._conns) + len(self._pending) + len(self._ready_conns)
+    parked = property(_get_parked, doc=_get_parked.__doc__)
+    
+    def start(self):
+        """Start the polling thread."""
+        import fcntl
+        self._poll = _Poll()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._poll.register(self._wake_r)
+        
+        self.ready = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setName("CP WSGIServer " + self._thread.getName() + " (poller)")
+        self._thread.setDaemon(True)
+        self._thread.start()
+    
+    def put(self, conn):
+        """Park the given connection until it sends a request (thread-safe)."""
+        if not self.ready:
+            conn.close()
+            return
+        conn.poller = self
+        conn.last_active = time.time()
+        self._lock.acquire()
+        try:
+            self._pending.append(conn)
+        finally:
+            self._lock.release()
+        self._wake()
+    
+    def _wake(self):
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            # The pipe is full, so the poller will wake up anyway.
+            pass
+    
+    def _run(self):
+        last_sweep = time.time()
+        while self.ready:
+            try:
+                # Retry the connections waiting for room soon.
+                events = self._poll.poll(self._ready_conns and 0.01 or 1)
+            except (select.error, IOError, OSError), e:
+                if e.args[0] in socket_error_eintr:
+                    continue
+                raise
+            
+            now = time.time()
+            for fd, event in events:
+                if fd == self._wake_r:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                
+                conn = self._conns.get(fd)
+                if conn is None:
+                    continue
+                try:
+                    ready = conn.poll_read()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    ready = None
+                
+                if ready is None:
+                    self._remove(fd)
+                    conn.close()
+                elif ready:
+                    self._remove(fd)
+                    conn.last_active = now
+                    self._ready_conns.append(conn)
+                else:
+                    conn.last_active = now
+            
+            if self._ready_conns:
+                # Never wait for room in the queue here: that would hold
+                # up all the other connections.
+                ready, self._ready_conns = self._ready_conns, []
+                timeout = self.server.requests.accepted_queue_timeout
+                for conn in ready:
+                    if now - conn.last_active > timeout:
+                        self.server.reject(conn)
+                    elif not self.server.dispatch(conn, block=False):
+                        self._ready_conns.append(conn)
+            
+            self._lock.acquire()
+            try:
+                pending, self._pending = self._pending, []
+            finally:
+                self._lock.release()
+            for conn in pending:
+                try:
+                    fd = conn.socket.fileno()
+                    self._poll.register(fd)
+                except (socket.error, IOError, OSError, ValueError):
+                    conn.close()
+                    continue
+                self._conns[fd] = conn
+            
+            if now - last_sweep >= 1:
+                last_sweep = now
+                for fd, conn in self._conns.items():
+                    if now - conn.last_active > self.timeout:
+                        self._remove(fd)
+                        conn.close()
+        
+        # Shutting down: close all parked connections.
+        for fd, conn in self._conns.items():
+            self._remove(fd)
+            conn.close()
+        for conn in self._pending + self._ready_conns:
+            conn.close()
+        self._pending = []
+        self._ready_conns = []
+        self._poll.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+    
+    def _remove(self, fd):
+        del self._conns[fd]
+        try:
+            self._poll.unregister(fd)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    
+    def stop(self, timeout=5):
+        """Stop the polling thread and close all parked connections."""
+        if not self.ready:
+            return
+        self.ready = False
+        self._wake()
+        if self._thread is not threading.currentThread():
+            self._thread.join(timeout)
 
 
 class SSLConnection:
@@ -1423,6 +2334,12 @@ else:
         fcntl.fcntl(fd, fcntl.F_SETFD, old_flags | fcntl.FD_CLOEXEC)
 
 
+# Python 2 doesn't define it, but Linux (since 3.9) and the BSDs have it.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+if SO_REUSEPORT is None and sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15
+
+
 class CherryPyWSGIServer(object):
     """An HTTP server for WSGI.
     
@@ -1440,14 +2357,43 @@ class CherryPyWSGIServer(object):
     numthreads: the number of worker threads to create (default 10).
     server_name: the string to set for WSGI's SERVER_NAME environ entry.
         Defaults to socket.gethostname().
-    max: the maximum number of queued requests (defaults to -1 = no limit).
+    max: the maximum number of worker threads (defaults to -1 = no limit).
+        If it is greater than numthreads, the pool grows and shrinks
+        between the two with the load (see ThreadPool).
     request_queue_size: the 'backlog' argument to socket.listen();
         specifies the maximum number of queued connections (default 5).
+    accepted_queue_size: the maximum number of accepted connections
+        waiting for a worker thread (defaults to -1 = no limit). What
+        happens when it is reached depends on overload_policy.
+    accepted_queue_timeout: how long (in seconds) to wait for room in a
+        full queue before giving up on a connection (default 10).
     timeout: the timeout in seconds for accepted connections (default 10).
     
     nodelay: if True (the default since 3.1), sets the TCP_NODELAY socket
         option.
     
+    overload_policy: what to do when the accepted queue is full. With
+        "reject" (the default), new connections get an immediate
+        "503 Service Unavailable" with a Retry-After of retry_after seconds.
+        With "pause", the server stops calling accept() until there is room
+        again, so new connections wait in the listen backlog.
+    
+    The time a connection spent waiting for a worker thread is given to
+    the application as environ["wsgiserver.queue_wait"] (in seconds).
+    
+    reuse_port: if True, sets the SO_REUSEPORT socket option, so that
+        several independent server processes can listen on the same TCP
+        port and have the kernel balance connections between them.
+        Ignored for UNIX sockets.
+    acceptors: the number of threads calling accept() on the socket
+        (default 1). start() runs one of them in the calling thread.
+    
+    park_idle_connections: if True (the default), connections wait in a
+        ConnectionPoller instead of a worker thread until a complete request
+        head has arrived, both when they are new and between keep-alive
+        requests. Needs select.epoll or select.poll; without them (e.g. on
+        Windows) each connection keeps its worker until it is closed.
+    
     protocol: the version string to write in the Status-Line of all
         HTTP responses. For example, "HTTP/1.1" (the default). This
         also limits the supported features used in the response.
@@ -1455,8 +2401,8 @@ class CherryPyWSGIServer(object):
     
     SSL/HTTPS
     ---------
-    The OpenSSL module must be importable for SSL functionality.
-    You can obtain it from http://pyopenssl.sourceforge.net/
+    SSL is provided by the builtin ssl module (Python 2.7.9 or later), or
+    by pyOpenSSL (http://pyopenssl.sourceforge.net/).
     
     ssl_certificate: the filename of the server SSL certificate.
     ssl_privatekey: the filename of the server's private key file.
@@ -1464,6 +2410,26 @@ class CherryPyWSGIServer(object):
     If either of these is None (both are None by default), this server
     will not use SSL. If both are given and are valid, they will be read
     on server start and used in the SSL context for the listening socket.
+    
+    ssl_module: "builtin" or "pyopenssl". The default (None) is "builtin"
+        if the ssl module is recent enough, else "pyopenssl".
+    
+    With the builtin module, the certificate file may also contain the
+    intermediate certificates, and:
+    
+    ssl_ciphers: an OpenSSL cipher list to use instead of the defaults.
+    ssl_session_tickets: if True (the default), clients may resume their
+        sessions with TLS session tickets. Sessions can also be resumed by
+        session ID, from the session cache that OpenSSL keeps for each
+        context. Since the context is created by listen(), the processes of
+        a PreforkServer share the same ticket keys.
+    ssl_reload_interval: if non-zero, check the certificate and key files
+        this often (in seconds) and call load_ssl_context when they change,
+        so that renewed certificates are used without a restart.
+    ssl_context: the current ssl.SSLContext (set by load_ssl_context).
+    
+    The TLS handshake is done by the worker thread which first handles
+    the connection, rather than by the thread calling accept().
     """
     
     protocol = "HTTP/1.1"
@@ -1471,8 +2437,15 @@ class CherryPyWSGIServer(object):
     version = "CherryPy/3.1.2"
     ready = False
     _interrupt = None
+    socket = None
     
     nodelay = True
+    reuse_port = False
+    acceptors = 1
+    park_idle_connections = True
+    overload_policy = "reject"
+    retry_after = 1
+    poller = None
     
     ConnectionClass = HTTPConnection
     environ = {}
@@ -1481,9 +2454,20 @@ class CherryPyWSGIServer(object):
     ssl_certificate = None
     ssl_private_key = None
     
+    ssl_module = None
+    ssl_ciphers = None
+    ssl_session_tickets = True
+    ssl_reload_interval = 0
+    ssl_context = None
+    _ssl_mtimes = None
+    _ssl_checked = 0
+    
     def __init__(self, bind_addr, wsgi_app, numthreads=10, server_name=None,
-                 max=-1, request_queue_size=5, timeout=10, shutdown_timeout=5):
-        self.requests = ThreadPool(self, min=numthreads or 1, max=max)
+                 max=-1, request_queue_size=5, timeout=10, shutdown_timeout=5,
+                 accepted_queue_size=-1, accepted_queue_timeout=10):
+        self.requests = ThreadPool(self, min=numthreads or 1, max=max,
+                                   accepted_queue_size=accepted_queue_size,
+                                   accepted_queue_timeout=accepted_queue_timeout)
         
         if callable(wsgi_app):
             # We've been handed a single wsgi_app, in CP-2.1 style.
@@ -1556,6 +2540,57 @@ class CherryPyWSGIServer(object):
         # trap those exceptions in whatever code block calls start().
         self._interrupt = None
         
+        if self.socket is None:
+            self.listen()
+        
+        # Create worker threads
+        self.requests.start()
+        
+        if self.park_idle_connections and poll_available:
+            self.poller = ConnectionPoller(self, self.timeout)
+            self.poller.start()
+        
+        self.ready = True
+        for i in xrange(self.acceptors - 1):
+            t = threading.Thread(target=self._accept)
+            t.setName("CP WSGIServer " + t.getName() + " (acceptor)")
+            t.setDaemon(True)
+            t.start()
+        
+        while self.ready:
+            self.tick()
+            if self.interrupt:
+                while self.interrupt is True:
+                    # Wait for self.stop() to complete. See _set_interrupt.
+                    time.sleep(0.1)
+                if self.interrupt:
+                    raise self.interrupt
+    
+    def _accept(self):
+        """Accept connections until the server stops (extra acceptor threads)."""
+        try:
+            while self.ready:
+                self.tick()
+        except (KeyboardInterrupt, SystemExit), exc:
+            self.interrupt = exc
+    
+    def listen(self, fd=None, family=None):
+        """Create the server socket, bind it and start listening on it.
+        
+        This is done by start() unless the socket already exists, so a
+        socket created here can be shared by several processes (see
+        PreforkServer).
+        
+        If fd is given, it is a socket of the given family which is
+        already bound (e.g. inherited from the process which exec'd this
+        one), and is used instead of a new one.
+        """
+        if fd is not None:
+            self.bind(family, socket.SOCK_STREAM, fd=fd)
+            self.socket.settimeout(1)
+            self.socket.listen(self.request_queue_size)
+            return
+        
         # Select the appropriate socket
         if isinstance(self.bind_addr, basestring):
             # AF_UNIX socket
@@ -1598,61 +2633,98 @@ class CherryPyWSGIServer(object):
         # Timeout so KeyboardInterrupt can be caught on Win32
         self.socket.settimeout(1)
         self.socket.listen(self.request_queue_size)
-        
-        # Create worker threads
-        self.requests.start()
-        
-        self.ready = True
-        while self.ready:
-            self.tick()
-            if self.interrupt:
-                while self.interrupt is True:
-                    # Wait for self.stop() to complete. See _set_interrupt.
-                    time.sleep(0.1)
-                if self.interrupt:
-                    raise self.interrupt
     
-    def bind(self, family, type, proto=0):
-        """Create (or recreate) the actual socket object."""
-        self.socket = socket.socket(family, type, proto)
+    def bind(self, family, type, proto=0, fd=None):
+        """Create (or recreate) the actual socket object.
+        
+        If fd is given, the socket object is made from that (already
+        bound) socket, which is then closed.
+        """
+        if fd is None:
+            self.socket = socket.socket(family, type, proto)
+        else:
+            # (fromfd returns a bare _socket.socket in Python 2.)
+            self.socket = socket.socket(_sock=socket.fromfd(fd, family, type, proto))
+            os.close(fd)
         prevent_socket_inheritance(self.socket)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        if self.nodelay:
+        is_unix = isinstance(self.bind_addr, basestring)
+        if self.reuse_port and not is_unix:
+            # Several processes may listen on the same port; the kernel
+            # spreads the connections between them.
+            if SO_REUSEPORT is None:
+                raise socket.error("SO_REUSEPORT is not supported on this platform.")
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.nodelay and not is_unix:
             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if self.ssl_certificate and self.ssl_private_key:
-            if SSL is None:
-                raise ImportError("You must install pyOpenSSL to use HTTPS.")
-            
-            # See http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/442473
-            ctx = SSL.Context(SSL.SSLv23_METHOD)
-            ctx.use_privatekey_file(self.ssl_private_key)
-            ctx.use_certificate_file(self.ssl_certificate)
-            self.socket = SSLConnection(ctx, self.socket)
-            self.populate_ssl_environ()
+            ssl_module = self.ssl_module
+            if ssl_module is None:
+                ssl_module = ssl and "builtin" or "pyopenssl"
             
-            # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
-            # activate dual-stack. See http://www.cherrypy.org/ticket/871.
-            if (not isinstance(self.bind_addr, basestring)
-                and self.bind_addr[0] == '::' and family == socket.AF_INET6):
-                try:
-                    self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
-                except (AttributeError, socket.error):
-                    # Apparently, the socket option is not available in
-                    # this machine's TCP stack
-                    pass
+            if ssl_module == "builtin":
+                if ssl is None:
+                    raise ImportError("The builtin ssl module needs "
+                                      "Python 2.7.9 or later.")
+                # Accepted sockets are wrapped in tick().
+                self.load_ssl_context()
+                self.environ.update({"wsgi.url_scheme": "https",
+                                     "HTTPS": "on"})
+            else:
+                if SSL is None:
+                    raise ImportError("You must install pyOpenSSL to use HTTPS.")
+                
+                # See http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/442473
+                ctx = SSL.Context(SSL.SSLv23_METHOD)
+                ctx.use_privatekey_file(self.ssl_private_key)
+                ctx.use_certificate_file(self.ssl_certificate)
+                self.socket = SSLConnection(ctx, self.socket)
+                self.populate_ssl_environ()
+        
+        # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
+        # activate dual-stack. See http://www.cherrypy.org/ticket/871.
+        if (not is_unix and self.bind_addr[0] == '::'
+            and family == socket.AF_INET6):
+            try:
+                self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            except (AttributeError, socket.error):
+                # Apparently, the socket option is not available in
+                # this machine's TCP stack
+                pass
         
-        self.socket.bind(self.bind_addr)
+        if fd is None:
+            self.socket.bind(self.bind_addr)
     
     def tick(self):
         """Accept a new connection and put it on the Queue."""
+        if self.overload_policy == "pause" and self.requests.full():
+            # Leave new connections in the listen backlog for now.
+            time.sleep(0.01)
+            return
+        
+        sock = self.socket
+        if sock is None:
+            # Stopped by another thread.
+            return
+        
+        if self.ssl_reload_interval and self.ssl_context is not None:
+            self.check_ssl_files()
+        
         try:
-            s, addr = self.socket.accept()
+            s, addr = sock.accept()
             prevent_socket_inheritance(s)
             if not self.ready:
                 return
             if hasattr(s, 'settimeout'):
                 s.settimeout(self.timeout)
             
+            ctx = self.ssl_context
+            if ctx is not None:
+                # The handshake is left to a worker thread (see
+                # HTTPConnection.handshake).
+                s = ctx.wrap_socket(s, server_side=True,
+                                    do_handshake_on_connect=False)
+            
             environ = self.environ.copy()
             # SERVER_SOFTWARE is common for IIS. It's also helpful for
             # us to pass a default value for the "Server" response header.
@@ -1676,7 +2748,12 @@ class CherryPyWSGIServer(object):
                 environ["REMOTE_PORT"] = str(addr[1])
             
             conn = self.ConnectionClass(s, self.wsgi_app, environ)
-            self.requests.put(conn)
+            if self.overload_policy == "reject" and self.requests.full():
+                self.reject(conn)
+            elif self.poller is not None:
+                self.poller.put(conn)
+            else:
+                self.dispatch(conn)
         except socket.timeout:
             # The only reason for the timeout in start() is so we can
             # notice keyboard interrupts on Win32, which don't interrupt
@@ -1699,6 +2776,44 @@ class CherryPyWSGIServer(object):
                 return
             raise
     
+    def dispatch(self, conn, block=True):
+        """Put the given connection on the Queue (or reject it if it's full).
+        
+        If block is False, don't wait for room in a full Queue: with the
+        "pause" overload_policy, return False instead (the caller keeps
+        the connection and tries again later). Otherwise return True.
+        """
+        if self.overload_policy == "reject" and self.requests.full():
+            self.reject(conn)
+            return True
+        try:
+            if block:
+                self.requests.put(conn)
+            else:
+                self.requests.put_nowait(conn)
+        except Queue.Full:
+            if not block and self.overload_policy == "pause":
+                return False
+            self.reject(conn)
+        return True
+    
+    def reject(self, conn):
+        """Answer the given connection with 503 Service Unavailable and close it."""
+        if not conn.rfile.encrypted:
+            # (Writing to an SSL connection could block on the handshake.)
+            msg = "The server is overloaded. Please try again later."
+            buf = ["%s 503 Service Unavailable\r\n" % self.protocol,
+                   "Content-Length: %s\r\n" % len(msg),
+                   "Content-Type: text/plain\r\n",
+                   "Retry-After: %s\r\n" % self.retry_after,
+                   "Connection: close\r\n",
+                   "\r\n", msg]
+            try:
+                conn.wfile.sendall("".join(buf))
+            except socket.error:
+                pass
+        conn.close()
+    
     def _get_interrupt(self):
         return self._interrupt
     def _set_interrupt(self, interrupt):
@@ -1745,8 +2860,54 @@ class CherryPyWSGIServer(object):
                 sock.close()
             self.socket = None
         
+        if self.poller is not None:
+            self.poller.stop(self.shutdown_timeout)
+            self.poller = None
         self.requests.stop(self.shutdown_timeout)
     
+    def load_ssl_context(self):
+        """(Re)load ssl_certificate and ssl_private_key into a new SSLContext.
+        
+        Connections accepted from then on use the new context; open ones
+        keep the old one. Used by the builtin ssl module only.
+        """
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ctx.load_cert_chain(self.ssl_certificate, self.ssl_private_key)
+        if self.ssl_ciphers:
+            ctx.set_ciphers(self.ssl_ciphers)
+        if not self.ssl_session_tickets:
+            ctx.options |= getattr(ssl, "OP_NO_TICKET", 0x4000)
+        
+        self._ssl_mtimes = self._get_ssl_mtimes()
+        self._ssl_checked = time.time()
+        self.ssl_context = ctx
+    
+    def _get_ssl_mtimes(self):
+        try:
+            return [os.stat(f).st_mtime
+                    for f in (self.ssl_certificate, self.ssl_private_key)]
+        except OSError:
+            return None
+    
+    def check_ssl_files(self):
+        """Reload the SSL context if the certificate or key file changed.
+        
+        Checks at most once every ssl_reload_interval seconds.
+        """
+        now = time.time()
+        if now - self._ssl_checked < self.ssl_reload_interval:
+            return
+        self._ssl_checked = now
+        
+        mtimes = self._get_ssl_mtimes()
+        if mtimes is not None and mtimes != self._ssl_mtimes:
+            try:
+                self.load_ssl_context()
+            except (IOError, ssl.SSLError):
+                # Probably caught halfway through an update. Keep the
+                # current context and try again next time.
+                pass
+    
     def populate_ssl_environ(self):
         """Create WSGI environ entries to be merged into each request."""
         cert = open(self.ssl_certificate, 'rb').read()
@@ -1792,3 +2953,228 @@ class CherryPyWSGIServer(object):
         
         self.environ.update(ssl_environ)
 
+
+class PreforkServer(object):
+    """Runs a CherryPyWSGIServer in several processes (POSIX only).
+    
+    With the GIL, a single server process can't use more than one CPU.
+    PreforkServer binds the server socket once, in the master process, and
+    forks `workers` child processes which each run the server (with its
+    own threads) on that shared socket. Children which exit unexpectedly
+    are replaced.
+    
+    Signals to the master process:
+        SIGHUP: call `reload` (if given) and reload the server's
+            ssl_context (if any), then replace the children one at a
+            time, so that there is no moment without workers.
+            
+            With `reexec`, the master instead runs its program again
+            (sys.argv, in the same process), so that the new children run
+            the new code, including that of the __main__ module, which
+            can't be reloaded. The new master keeps the server socket and
+            starts its children before stopping the old ones.
+        SIGTERM, SIGINT: stop the children gracefully and exit.
+    """
+    
+    # Seconds to wait before replacing a child which died right away.
+    respawn_delay = 1
+    
+    # The environment variable which passes the server socket and the
+    # children on to the re-executed master.
+    environ_key = "WSGISERVER_PREFORK"
+    
+    def __init__(self, server, workers=2, reload=None, reexec=False):
+        self.server = server
+        self.workers = workers
+        self.reload = reload
+        self.reexec = reexec
+        self.children = {}
+        self._signals = []
+    
+    def start(self):
+        """Fork the children and watch over them until stopped."""
+        import signal
+        inherited = os.environ.pop(self.environ_key, None)
+        old_children = []
+        if inherited:
+            fd, family, pids = inherited.split(":")
+            self.server.listen(int(fd), int(family))
+            old_children = [int(pid) for pid in pids.split(",") if pid]
+        else:
+            self.server.listen()
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._signal)
+        
+        try:
+            for i in xrange(self.workers):
+                self.spawn()
+            
+            # Children of the master which exec'd this one.
+            for pid in old_children:
+                self.children[pid] = 0
+                self.terminate(pid)
+            
+            while True:
+                while self._signals:
+                    if self._signals.pop(0) == signal.SIGHUP:
+                        self.restart()
+                    else:
+                        return
+                
+                self.reap()
+                while len(self.children) < self.workers:
+                    self.spawn()
+                time.sleep(0.5)
+        finally:
+            self.stop()
+    
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+    
+    def spawn(self):
+        """Fork a child process which runs the server."""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        
+        # In the child.
+        import signal
+        def terminate(signum, frame):
+            raise SystemExit
+        
+        status = 0
+        try:
+            try:
+                # The master handles these for the whole group.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, terminate)
+                self.server.start()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except:
+                traceback.print_exc()
+                status = 1
+            try:
+                self.server.stop()
+            except:
+                pass
+        finally:
+            os._exit(status)
+    
+    def reap(self):
+        """Collect children which have exited."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.ECHILD:
+                    self.children.clear()
+                    return
+                raise
+            if not pid:
+                return
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            sys.stderr.write("%s: worker %d exited with status %d\n"
+                             % (self.server, pid, status))
+            if time.time() - started < self.respawn_delay:
+                # Don't fork as fast as possible if children die at once.
+                time.sleep(self.respawn_delay)
+    
+    def restart(self):
+        """Reload, then replace the children one at a time."""
+        if self.reexec:
+            try:
+                self.execute()
+            except:
+                # Carry on with this program.
+                traceback.print_exc()
+        if self.reload is not None:
+            try:
+                self.reload()
+            except:
+                traceback.print_exc()
+        if self.server.ssl_context is not None:
+            # New children share the new context (and its ticket keys).
+            try:
+                self.server.load_ssl_context()
+            except:
+                traceback.print_exc()
+        for pid in self.children.keys():
+            self.spawn()
+            self.terminate(pid)
+    
+    def execute(self):
+        """Run this program again in this process, keeping the server
+        socket and the children (see `reexec`)."""
+        sock = self.server.socket
+        name = sock.getsockname()
+        if isinstance(name, basestring):
+            family = socket.AF_UNIX
+        elif len(name) == 4:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        
+        fd = sock.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        os.environ[self.environ_key] = "%d:%d:%s" % (
+            fd, family, ",".join([str(pid) for pid in self.children]))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        finally:
+            # Only reached if the exec failed.
+            del os.environ[self.environ_key]
+            prevent_socket_inheritance(sock)
+    
+    def terminate(self, pid, timeout=None, signal_child=True):
+        """Stop the given child gracefully, killing it after timeout seconds."""
+        import signal
+        if timeout is None:
+            timeout = self.server.shutdown_timeout + 5
+        if signal_child:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        
+        end = time.time() + timeout
+        while pid in self.children:
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                done = pid
+            if done:
+                del self.children[pid]
+            elif time.time() > end:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                end += 5
+            else:
+                time.sleep(0.1)
+    
+    def stop(self):
+        """Stop all children and close the server socket."""
+        import signal
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.children.keys():
+            self.terminate(pid, signal_child=False)
+        if self.server.socket is not None:
+            self.server.socket.close()
+            self.server.socket = None